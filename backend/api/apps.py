@@ -1,6 +1,15 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
 
 
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from recipes.models import Ingredient
+
+        from .search import invalidate_ingredient_index
+
+        for signal in (post_save, post_delete):
+            signal.connect(invalidate_ingredient_index, sender=Ingredient)
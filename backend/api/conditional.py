@@ -0,0 +1,62 @@
+import json
+from functools import wraps
+from hashlib import md5
+
+from django.utils.cache import (
+    get_conditional_response, patch_cache_control, patch_vary_headers
+)
+from django.utils.http import http_date, quote_etag
+
+# Ответ зависит от пользователя: кэшировать только в браузере
+# и перепроверять при каждом обращении
+PRIVATE_CACHE_CONTROL = {'private': True, 'no_cache': True}
+
+
+def make_etag(*parts):
+    """Строит ETag из значений, от которых зависит тело ответа."""
+    return quote_etag(md5(
+        json.dumps(parts, default=str, sort_keys=True).encode()
+    ).hexdigest())
+
+
+def normalize_query(request):
+    """Параметры запроса в каноническом порядке."""
+    return sorted(
+        (name, sorted(values))
+        for name, values in request.query_params.lists()
+    )
+
+
+def conditional_get(method):
+    """
+    Декоратор действий представления для условных GET-запросов.
+
+    Валидаторы (ETag, Last-Modified) вычисляет метод представления
+    get_validators(request, *args, **kwargs) по версиям данных, без
+    сериализации. При совпадении с If-None-Match / If-Modified-Since
+    клиенту отдается 304 без тела.
+
+    Заголовок Cache-Control задает метод представления
+    get_cache_control(request), по умолчанию PRIVATE_CACHE_CONTROL.
+    """
+    @wraps(method)
+    def wrapper(self, request, *args, **kwargs):
+        etag, last_modified = self.get_validators(request, *args, **kwargs)
+        last_modified = last_modified and int(last_modified.timestamp())
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if response is None:
+            response = method(self, request, *args, **kwargs)
+        if etag:
+            response['ETag'] = etag
+        if last_modified:
+            response['Last-Modified'] = http_date(last_modified)
+        cache_control = getattr(
+            self, 'get_cache_control', lambda request: PRIVATE_CACHE_CONTROL
+        )(request)
+        patch_cache_control(response, **cache_control)
+        if cache_control.get('private'):
+            patch_vary_headers(response, ('Authorization',))
+        return response
+    return wrapper
@@ -0,0 +1,61 @@
+import json
+from hashlib import md5
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Q
+from rest_framework.exceptions import ValidationError
+
+from recipes.models import Tag
+
+from .filters import normalize_filters
+from .versions import get_table_versions
+
+FACETS_PARAM = 'facets'
+TAGS_FACET = 'tags'
+UNKNOWN_FACETS = 'Неизвестные разрезы: {}. Доступны: ' + TAGS_FACET
+FACETS_CACHE_KEY = 'recipe-facets-v1:{}'
+# Таблицы, от которых зависят счетчики рецептов по тегам
+FACETS_TABLES = ('recipe', 'favorite', 'shoppingcart', 'tag')
+
+
+def get_requested_facets(request):
+    """Разрезы из параметра facets (через запятую или повтором параметра)."""
+    facets = {
+        name.strip()
+        for value in request.query_params.getlist(FACETS_PARAM)
+        for name in value.split(',') if name.strip()
+    }
+    unknown = facets - {TAGS_FACET}
+    if unknown:
+        raise ValidationError(
+            {FACETS_PARAM: UNKNOWN_FACETS.format(', '.join(sorted(unknown)))}
+        )
+    return facets
+
+
+def count_tags(recipes):
+    """
+    Число рецептов выборки по каждому тегу одним сгруппированным запросом.
+    Теги без рецептов в выборке возвращаются с нулем.
+    """
+    return list(Tag.objects.annotate(
+        count=Count('recipes', filter=Q(recipes__in=recipes.values('pk')))
+    ).values('id', 'name', 'slug', 'count'))
+
+
+def get_tag_facets(view, recipes, request):
+    """
+    Счетчики рецептов по тегам для выборки, построенной RecipeFilter.
+    Кэшируются по нормализованным параметрам фильтрации и версиям таблиц,
+    влияющих на результат.
+    """
+    key = FACETS_CACHE_KEY.format(md5(json.dumps([
+        normalize_filters(view.filterset_class, request),
+        get_table_versions(request, *FACETS_TABLES),
+    ], sort_keys=True).encode()).hexdigest())
+    facets = cache.get(key)
+    if facets is None:
+        facets = count_tags(recipes)
+        cache.set(key, facets, settings.RECIPE_FACETS_CACHE_TIMEOUT)
+    return facets
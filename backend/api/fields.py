@@ -0,0 +1,137 @@
+import filetype
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.files.uploadedfile import UploadedFile
+from drf_extra_fields.fields import Base64FieldMixin, Base64ImageField
+from rest_framework import serializers
+from rest_framework.relations import MANY_RELATION_KWARGS, ManyRelatedField
+
+from recipes.images import get_image_urls
+
+# Сколько первых байт файла нужно для определения типа по сигнатуре
+SIGNATURE_SIZE = 8192
+
+
+class BulkPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """
+    Первичный ключ, который при проверке только приводится к типу ключа.
+    Объекты всех ключей списка находятся затем одним запросом IN
+    (см. BulkManyRelatedField, BulkRelatedListSerializer), а в ошибках
+    перечисляются все отсутствующие ключи.
+    """
+
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        list_kwargs = {'child_relation': cls(*args, **kwargs)}
+        for key in kwargs:
+            if key in MANY_RELATION_KWARGS:
+                list_kwargs[key] = kwargs[key]
+        return BulkManyRelatedField(**list_kwargs)
+
+    def to_internal_value(self, data):
+        if self.pk_field is not None:
+            data = self.pk_field.to_internal_value(data)
+        try:
+            return self.get_queryset().model._meta.pk.to_python(data)
+        except DjangoValidationError:
+            self.fail('incorrect_type', data_type=type(data).__name__)
+
+    def resolve(self, pks):
+        """Возвращает найденные объекты {ключ: объект} одним запросом."""
+        return self.get_queryset().in_bulk(set(pks))
+
+    def missing_error(self, pk):
+        return self.error_messages['does_not_exist'].format(pk_value=pk)
+
+
+class BulkManyRelatedField(ManyRelatedField):
+    """Список ключей BulkPrimaryKeyRelatedField."""
+
+    def to_internal_value(self, data):
+        pks = super().to_internal_value(data)
+        objects = self.child_relation.resolve(pks)
+        missing = [pk for pk in dict.fromkeys(pks) if pk not in objects]
+        if missing:
+            raise serializers.ValidationError(
+                [self.child_relation.missing_error(pk) for pk in missing],
+                code='does_not_exist'
+            )
+        return [objects[pk] for pk in pks]
+
+
+class BulkRelatedListSerializer(serializers.ListSerializer):
+    """
+    Список вложенных объектов, у которых поля BulkPrimaryKeyRelatedField
+    разрешаются одним запросом на поле. Ошибки отсутствующих ключей
+    выдаются в формате ListSerializer: по словарю на каждый элемент.
+    """
+
+    def to_internal_value(self, data):
+        items = super().to_internal_value(data)
+        errors = [{} for _ in items]
+        for name, field in self.child.fields.items():
+            if not isinstance(field, BulkPrimaryKeyRelatedField):
+                continue
+            objects = field.resolve(item[field.source] for item in items)
+            for item, item_errors in zip(items, errors):
+                pk = item[field.source]
+                if pk in objects:
+                    item[field.source] = objects[pk]
+                else:
+                    item_errors[name] = [field.missing_error(pk)]
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        return items
+
+
+class UploadedImageField(Base64FieldMixin, serializers.FileField):
+    """
+    Изображение в base64 (JSON) или файлом (multipart/form-data). Файл
+    из multipart Django сохраняет во временный файл на диске, если он
+    больше settings.FILE_UPLOAD_MAX_MEMORY_SIZE. В запросе тип файла
+    проверяется только по сигнатуре, без разбора изображения: файл
+    целиком проверяет и перекодирует обработка загрузок
+    (см. recipes/images.py).
+    """
+
+    ALLOWED_TYPES = Base64ImageField.ALLOWED_TYPES
+    INVALID_FILE_MESSAGE = Base64ImageField.INVALID_FILE_MESSAGE
+    INVALID_TYPE_MESSAGE = Base64ImageField.INVALID_TYPE_MESSAGE
+
+    def to_internal_value(self, data):
+        if not isinstance(data, UploadedFile):
+            return super().to_internal_value(data)
+        header = data.read(SIGNATURE_SIZE)
+        data.seek(0)
+        extension = self.get_file_extension(data.name, header)
+        if extension not in self.ALLOWED_TYPES:
+            raise serializers.ValidationError(self.INVALID_TYPE_MESSAGE)
+        # Имя файла от клиента не используется
+        data.name = f'{self.get_file_name(header)}.{extension}'
+        return serializers.FileField.to_internal_value(self, data)
+
+    def get_file_extension(self, filename, decoded_file):
+        extension = filetype.guess_extension(decoded_file)
+        return 'jpg' if extension == 'jpeg' else extension
+
+
+class ImageVariantsField(serializers.Field):
+    """
+    Адреса вариантов изображения поля image_field: миниатюры, карточки
+    и полного размера в WebP (см. recipes/images.py).
+    """
+
+    def __init__(self, image_field, **kwargs):
+        self.image_field = image_field
+        kwargs['source'] = '*'
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, instance):
+        urls = get_image_urls(instance, self.image_field)
+        request = self.context.get('request')
+        if urls is None or request is None:
+            return urls
+        return {
+            variant: request.build_absolute_uri(url)
+            for variant, url in urls.items()
+        }
@@ -1,10 +1,11 @@
-from django.db.models import Case, CharField, Exists, OuterRef, Value, When
+from django.db.models import Case, CharField, Exists, F, OuterRef, Value, When
 from django_filters import ModelMultipleChoiceFilter, filters, rest_framework
 
 from recipes.models import Favorite, Ingredient, Recipe, ShoppingCart, Tag
 
 IS_FAVORITED_PARAM_NAME = 'is_favorited'
 IS_SHOPPING_CART_PARAM_NAME = 'is_in_shopping_cart'
+TAGS_ALL_PARAM_NAME = 'tags_all'
 
 
 class IngredientFilter(rest_framework.FilterSet):
@@ -32,17 +33,46 @@ class IngredientFilter(rest_framework.FilterSet):
         ).filter(name__icontains=value).order_by('priority', 'name')
 
 
+def normalize_filters(filterset_class, request):
+    """
+    Приводит параметры фильтрации запроса к каноническому виду: только
+    объявленные в фильтре параметры, в отсортированном порядке. Для
+    фильтров, зависящих от пользователя, добавляется его id.
+    Используется как ключ кэшей, производных от отфильтрованной выборки.
+    """
+    params = request.query_params
+    normalized = [
+        (name, sorted(params.getlist(name)))
+        for name in sorted(filterset_class.base_filters)
+        if params.get(name)
+    ]
+    personal = getattr(filterset_class, 'personal_filters', ())
+    if request.user.is_authenticated and any(
+        name in personal for name, _ in normalized
+    ):
+        normalized.append(('user', request.user.id))
+    return normalized
+
+
 class RecipeFilter(rest_framework.FilterSet):
     """
     Фильтр для рецептов с возможностью выбора нескольких тегов и автора,
     а также флагов: в избранном, в списке покупок.
+    Теги: tags - рецепты с любым из тегов, tags_all - со всеми тегами.
     """
 
+    personal_filters = (IS_FAVORITED_PARAM_NAME, IS_SHOPPING_CART_PARAM_NAME)
+
     author = filters.CharFilter(field_name='author')
     tags = ModelMultipleChoiceFilter(
-        field_name='tags__slug',
         to_field_name='slug',
-        queryset=Tag.objects.all()
+        queryset=Tag.objects.all(),
+        method='filter_tags'
+    )
+    tags_all = ModelMultipleChoiceFilter(
+        to_field_name='slug',
+        queryset=Tag.objects.all(),
+        method='filter_tags'
     )
     is_in_shopping_cart = filters.CharFilter(
         method='general_method')
@@ -53,6 +83,20 @@ class RecipeFilter(rest_framework.FilterSet):
         model = Recipe
         fields = ('tags', 'author')
 
+    def filter_tags(self, recipes, name, tags):
+        """
+        Сравнивает маску тегов рецепта с маской выбранных тегов: одно
+        условие над строкой рецепта, без соединения с тегами и DISTINCT.
+        """
+        if not tags:
+            return recipes
+        mask = Tag.get_mask(tags)
+        match = f'{name}_match'
+        recipes = recipes.alias(**{match: F('tags_mask').bitand(mask)})
+        if name == TAGS_ALL_PARAM_NAME:
+            return recipes.filter(**{match: mask})
+        return recipes.filter(**{f'{match}__gt': 0})
+
     def general_method(self, recipes, name, value):
         if not value or not self.request.user.is_authenticated:
             return recipes
@@ -0,0 +1,84 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Prefetch, prefetch_related_objects
+
+from recipes.models import RecipeIngredient
+
+from .serializers import RecipesReadSerializer, get_followed_authors
+from .versions import get_table_versions
+
+FRAGMENT_CACHE_KEY = 'recipe-fragment-v1:{}:{}:{}:{}:{}:{}'
+# Данные рецепта, которые загружаются только при промахе кэша
+RECIPE_PREFETCH = (
+    'tags',
+    Prefetch(
+        'recipeingredients',
+        queryset=RecipeIngredient.objects.select_related('ingredient')
+    ),
+)
+# Таблицы, данные которых входят в сериализованный рецепт
+FRAGMENT_TABLES = ('tag', 'ingredient')
+
+
+def get_fragment_key(recipe, versions, request):
+    return FRAGMENT_CACHE_KEY.format(
+        request.build_absolute_uri('/'),
+        recipe.pk,
+        recipe.updated_at.timestamp(),
+        recipe.author.updated_at.timestamp(),
+        *(versions[table] for table in FRAGMENT_TABLES)
+    )
+
+
+def overlay_viewer_fields(fragment, recipe, followed_authors):
+    """Дополняет общий для всех фрагмент признаками текущего пользователя."""
+    data = dict(fragment)
+    data['is_favorited'] = recipe.is_favorited
+    data['is_in_shopping_cart'] = recipe.is_in_shopping_cart
+    data['author'] = dict(
+        data['author'], is_subscribed=recipe.author_id in followed_authors
+    )
+    return data
+
+
+def serialize_recipes(recipes, request):
+    """
+    Сериализует рецепты через кэш фрагментов.
+
+    Фрагмент - представление рецепта, одинаковое для всех пользователей.
+    Ключ фрагмента включает время изменения рецепта и его автора, а также
+    версии таблиц тегов и продуктов, поэтому сигналы об их изменении
+    делают старые фрагменты недостижимыми. Теги и продукты загружаются
+    только для рецептов, которых нет в кэше. Признаки is_favorited,
+    is_in_shopping_cart (аннотации рецептов) и is_subscribed автора
+    накладываются при каждом ответе.
+    """
+    recipes = list(recipes)
+    versions = get_table_versions(request, *FRAGMENT_TABLES)
+    keys = {
+        recipe.pk: get_fragment_key(recipe, versions, request)
+        for recipe in recipes
+    }
+    fragments = cache.get_many(keys.values())
+    missing = [
+        recipe for recipe in recipes if keys[recipe.pk] not in fragments
+    ]
+    if missing:
+        prefetch_related_objects(missing, *RECIPE_PREFETCH)
+        serialized = RecipesReadSerializer(
+            missing, many=True, context={'request': request}
+        ).data
+        new_fragments = {
+            keys[recipe.pk]: fragment
+            for recipe, fragment in zip(missing, serialized)
+        }
+        cache.set_many(
+            new_fragments, settings.RECIPE_FRAGMENT_CACHE_TIMEOUT
+        )
+        fragments.update(new_fragments)
+    followed_authors = get_followed_authors(request)
+    return [
+        overlay_viewer_fields(
+            fragments[keys[recipe.pk]], recipe, followed_authors
+        ) for recipe in recipes
+    ]
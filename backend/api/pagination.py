@@ -1,6 +1,249 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+from collections import OrderedDict
+from datetime import datetime
+from functools import partial
+from hashlib import md5
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from .filters import normalize_filters
+from .versions import get_table_versions
+
+INVALID_CURSOR = 'Некорректный курсор'
+COUNT_CACHE_KEY = 'pagination-count:{}'
+
+
+class CountedPaginator(Paginator):
+    """Paginator, получающий число записей от внешней стратегии подсчета."""
+
+    def __init__(self, object_list, per_page, counter, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.counter = counter
+
+    @cached_property
+    def count(self):
+        count = self.counter(self.object_list)
+        return super().count if count is None else count
 
 
 class CustomPagination(PageNumberPagination):
+    """
+    Постраничная пагинация с опциональным режимом курсора (keyset).
+
+    Режим курсора включается параметром cursor (для первой страницы
+    достаточно пустого значения). Страницы выбираются условием по ключу
+    сортировки выборки, дополненному id, поэтому любая страница стоит
+    столько же, сколько первая, а подсчет записей не выполняется.
+
+    В постраничном режиме число записей для представлений с атрибутом
+    count_cache_tables кэшируется по нормализованным фильтрам и версиям
+    перечисленных таблиц. Для больших таблиц без фильтров на PostgreSQL
+    используется оценка планировщика. Признак count_is_exact в ответе
+    сообщает, точное ли число.
+    """
+
     page_size = 6
     page_size_query_param = 'limit'
+    cursor_query_param = 'cursor'
+    count_cache_timeout = settings.PAGINATION_COUNT_CACHE_TIMEOUT
+    count_estimate_threshold = settings.PAGINATION_COUNT_ESTIMATE_THRESHOLD
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.use_cursor = self.cursor_query_param in request.query_params
+        if not self.use_cursor:
+            self.request, self.view = request, view
+            self.count_is_exact = True
+            self.django_paginator_class = partial(
+                CountedPaginator, counter=self.count_objects
+            )
+            return super().paginate_queryset(queryset, request, view)
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+        self.request = request
+        self.ordering = self.get_ordering(queryset)
+        position, reverse = self.decode_cursor(request, queryset.model)
+        ordering = self.ordering
+        if reverse:
+            ordering = [self.invert(field) for field in ordering]
+        if position is not None:
+            queryset = queryset.filter(self.keyset_filter(ordering, position))
+        results = list(queryset.order_by(*ordering)[:page_size + 1])
+        has_more = len(results) > page_size
+        self.page = results[:page_size]
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = position is not None
+        return self.page
+
+    def count_objects(self, queryset):
+        """
+        Возвращает число записей выборки из кэша или оценку планировщика.
+        None означает точный подсчет без кэширования.
+        """
+        tables = getattr(self.view, 'count_cache_tables', None)
+        if not tables:
+            return None
+        count = self.estimate_count(queryset)
+        if count is not None:
+            self.count_is_exact = False
+            return count
+        key = self.get_count_cache_key(queryset, tables)
+        count = cache.get(key)
+        if count is None:
+            count = queryset.count()
+            cache.set(key, count, self.count_cache_timeout)
+        return count
+
+    def estimate_count(self, queryset):
+        """Оценка числа строк таблицы без фильтров (только PostgreSQL)."""
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql' or queryset.query.where:
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT reltuples::bigint FROM pg_class '
+                'WHERE oid = %s::regclass',
+                [queryset.model._meta.db_table]
+            )
+            row = cursor.fetchone()
+        if row is None or row[0] < self.count_estimate_threshold:
+            return None
+        return row[0]
+
+    def get_count_cache_key(self, queryset, tables):
+        filterset_class = getattr(self.view, 'filterset_class', None)
+        key = json.dumps([
+            queryset.model._meta.label,
+            normalize_filters(filterset_class, self.request)
+            if filterset_class else [],
+            get_table_versions(self.request, *tables),
+        ], sort_keys=True)
+        return COUNT_CACHE_KEY.format(md5(key.encode()).hexdigest())
+
+    def get_paginated_response(self, data):
+        response = OrderedDict()
+        if not self.use_cursor:
+            response['count'] = self.page.paginator.count
+            response['count_is_exact'] = self.count_is_exact
+        response['next'] = self.get_next_link()
+        response['previous'] = self.get_previous_link()
+        response['results'] = data
+        return Response(response)
+
+    def get_next_link(self):
+        if not self.use_cursor:
+            return super().get_next_link()
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.use_cursor:
+            return super().get_previous_link()
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    @staticmethod
+    def invert(field):
+        return field[1:] if field.startswith('-') else f'-{field}'
+
+    @staticmethod
+    def get_ordering(queryset):
+        """
+        Ключ сортировки выборки (или модели по умолчанию),
+        дополненный id для однозначности.
+        """
+        ordering = list(
+            queryset.query.order_by or queryset.model._meta.ordering
+        )
+        if not {'id', '-id', 'pk', '-pk'} & set(ordering):
+            descending = bool(ordering) and ordering[-1].startswith('-')
+            ordering.append('-id' if descending else 'id')
+        return ordering
+
+    @staticmethod
+    def keyset_filter(ordering, position):
+        """
+        Условие "строго после позиции" для составного ключа:
+        (a > x) OR (a = x AND b > y) OR ...
+        """
+        condition = Q()
+        equal = Q()
+        for field, value in zip(ordering, position):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            condition |= equal & Q(**{f'{name}__{lookup}': value})
+            equal &= Q(**{name: value})
+        return condition
+
+    def decode_cursor(self, request, model):
+        encoded = request.query_params[self.cursor_query_param]
+        if not encoded:
+            return None, False
+        try:
+            cursor = json.loads(urlsafe_b64decode(encoded.encode()))
+            position, reverse = cursor['p'], bool(cursor['r'])
+        except (BinasciiError, ValueError, TypeError, KeyError):
+            raise NotFound(INVALID_CURSOR)
+        if not isinstance(position, list) or (
+            len(position) != len(self.ordering)
+        ):
+            raise NotFound(INVALID_CURSOR)
+        try:
+            position = [
+                self.to_python(model, field, value)
+                for field, value in zip(self.ordering, position)
+            ]
+        except (TypeError, ValueError, ValidationError):
+            raise NotFound(INVALID_CURSOR)
+        return position, reverse
+
+    @staticmethod
+    def to_python(model, field, value):
+        """Значение позиции курсора в типе поля сортировки."""
+        name = field.lstrip('-')
+        try:
+            model_field = (
+                model._meta.pk if name == 'pk' else model._meta.get_field(name)
+            )
+        except FieldDoesNotExist:
+            # Аннотация: тип неизвестен, допустимы только простые значения
+            model_field = None
+        if model_field is not None:
+            value = model_field.to_python(value)
+        if value is None or isinstance(value, (list, dict)):
+            raise ValueError(value)
+        return value
+
+    def encode_cursor(self, obj, reverse):
+        position = []
+        for field in self.ordering:
+            value = getattr(obj, field.lstrip('-'))
+            if isinstance(value, datetime):
+                # Полная точность, включая микросекунды
+                value = value.isoformat()
+            position.append(value)
+        encoded = urlsafe_b64encode(
+            json.dumps({'p': position, 'r': reverse}).encode()
+        ).decode()
+        url = remove_query_param(
+            self.request.build_absolute_uri(), self.page_query_param
+        )
+        return replace_query_param(url, self.cursor_query_param, encoded)
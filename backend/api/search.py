@@ -0,0 +1,105 @@
+from bisect import bisect_left
+from threading import Lock
+from time import monotonic
+
+from django.conf import settings
+from django.db import transaction
+
+from recipes.models import Ingredient, TableVersion
+
+INGREDIENT_TABLE = Ingredient._meta.model_name
+
+
+class IngredientIndex:
+    """
+    Индекс продуктов в памяти процесса для поиска по началу и вхождению.
+
+    Названия хранятся отсортированными: совпадения по началу строки
+    находятся двоичным поиском, вхождения - по индексу n-грамм с проверкой
+    кандидатов. Порядок выдачи как у IngredientFilter: сначала совпадения
+    в начале названия, затем остальные, каждая группа по названию без
+    учета регистра (как при сортировке PostgreSQL с локалью, в отличие от
+    двоичного порядка SQLite). Пробелы по краям запроса отбрасываются,
+    как делал CharFilter.
+
+    Индекс строится при первом поиске и перестраивается при смене версии
+    таблицы продуктов. Версия проверяется не чаще раза в
+    settings.INGREDIENT_INDEX_CHECK_INTERVAL секунд, а после изменения
+    продуктов в этом процессе - при следующем же поиске.
+    """
+
+    ngram_size = 3
+
+    def __init__(self):
+        self.lock = Lock()
+        self.version = None
+        self.updated_at = None
+        self.checked_at = None
+        self.keys = []
+        self.items = []
+        self.ngrams = {}
+
+    def invalidate(self):
+        self.checked_at = None
+
+    def ensure_fresh(self):
+        """Перестраивает индекс, если изменилась версия таблицы продуктов."""
+        if self.checked_at is not None and (
+            monotonic() - self.checked_at
+            < settings.INGREDIENT_INDEX_CHECK_INTERVAL
+        ):
+            return
+        with self.lock:
+            versions, updated_at = TableVersion.get_state(INGREDIENT_TABLE)
+            if versions[INGREDIENT_TABLE] != self.version:
+                self.build()
+                self.version = versions[INGREDIENT_TABLE]
+                self.updated_at = updated_at
+            self.checked_at = monotonic()
+
+    def build(self):
+        rows = sorted(
+            Ingredient.objects.values('id', 'name', 'measurement_unit'),
+            key=lambda row: (row['name'].lower(), row['name'], row['id'])
+        )
+        ngrams = {}
+        for position, row in enumerate(rows):
+            for ngram in self.split(row['name'].lower()):
+                ngrams.setdefault(ngram, []).append(position)
+        self.keys = [row['name'].lower() for row in rows]
+        self.items = rows
+        self.ngrams = ngrams
+
+    def split(self, text):
+        return {
+            text[i:i + self.ngram_size]
+            for i in range(len(text) - self.ngram_size + 1)
+        }
+
+    def search(self, value):
+        """Возвращает продукты, в названии которых есть value."""
+        self.ensure_fresh()
+        value = value.strip().lower()
+        keys = self.keys
+        start = position = bisect_left(keys, value)
+        while position < len(keys) and keys[position].startswith(value):
+            position += 1
+        prefix = range(start, position)
+        ngrams = self.split(value)
+        if ngrams:
+            candidates = sorted(set.intersection(*(
+                set(self.ngrams.get(ngram, ())) for ngram in ngrams
+            )))
+        else:
+            candidates = range(len(keys))
+        return [self.items[i] for i in prefix] + [
+            self.items[i] for i in candidates
+            if value in keys[i] and not start <= i < position
+        ]
+
+
+ingredient_index = IngredientIndex()
+
+
+def invalidate_ingredient_index(**kwargs):
+    transaction.on_commit(ingredient_index.invalidate)
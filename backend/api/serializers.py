@@ -1,14 +1,20 @@
 from collections import Counter
 
+from django.conf import settings
 from django.db import transaction
 from djoser.serializers import UserSerializer as UserSerializerDjoser
-from drf_extra_fields.fields import Base64ImageField
 from rest_framework import serializers
 
 from recipes.constants import MIN_AMOUNT, MIN_COOKING_TIME
+from recipes.images import enqueue_image
 from recipes.models import (
-    Favorite, Follow, Ingredient, Recipe, RecipeIngredient, ShoppingCart, Tag,
-    User
+    Favorite, Ingredient, Recipe, RecipeIngredient, ShoppingCart, Tag, User
+)
+from recipes.shopping_lists import change_recipe
+
+from .fields import (
+    BulkPrimaryKeyRelatedField, BulkRelatedListSerializer, ImageVariantsField,
+    UploadedImageField
 )
 
 REPETITIVE_ERROR = 'Повторения в запросе! Объекты: {}'
@@ -21,43 +27,89 @@ INGREDIENTS_VALIDATE = {
 TAGS_VALIDATE = {
     'error': 'Поле tags отсутствует или не прошло валидацию'
 }
+RECIPES_LIMIT_PARAM = 'recipes_limit'
+RECIPES_LIMIT_ERROR = 'Ожидается целое число от 0 до {}'
+FOLLOWED_AUTHORS_ATTRIBUTE = '_followed_authors'
+
+
+def get_recipes_limit(request):
+    """
+    Число рецептов каждого автора в подписках. По умолчанию и сверху
+    ограничено settings.MAX_RECIPES_LIMIT.
+    """
+    limit = request.query_params.get(RECIPES_LIMIT_PARAM)
+    if limit is None:
+        return settings.MAX_RECIPES_LIMIT
+    try:
+        limit = int(limit)
+    except ValueError:
+        limit = -1
+    if limit < 0:
+        raise serializers.ValidationError({
+            RECIPES_LIMIT_PARAM: RECIPES_LIMIT_ERROR.format(
+                settings.MAX_RECIPES_LIMIT
+            )
+        })
+    return min(limit, settings.MAX_RECIPES_LIMIT)
+
+
+def get_followed_authors(request):
+    """
+    Возвращает id авторов, на которых подписан пользователь запроса.
+    Загружаются одним запросом и запоминаются в объекте запроса, поэтому
+    все проверки подписки в рамках запроса обходятся без обращений к базе.
+    """
+    if request.user.is_anonymous:
+        return frozenset()
+    if not hasattr(request, FOLLOWED_AUTHORS_ATTRIBUTE):
+        setattr(request, FOLLOWED_AUTHORS_ATTRIBUTE, frozenset(
+            request.user.followers.values_list('author_id', flat=True)
+        ))
+    return getattr(request, FOLLOWED_AUTHORS_ATTRIBUTE)
 
 
 class UserSerializer(UserSerializerDjoser):
     """Обрабатывает модель пользователей."""
 
     avatar = serializers.ImageField(read_only=True)
+    avatar_variants = ImageVariantsField('avatar')
     is_subscribed = serializers.SerializerMethodField()
 
     class Meta(UserSerializerDjoser.Meta):
         model = User
-        fields = ['avatar', 'is_subscribed', *UserSerializerDjoser.Meta.fields]
+        fields = [
+            'avatar', 'avatar_variants', 'avatar_status', 'is_subscribed',
+            *UserSerializerDjoser.Meta.fields
+        ]
 
     def get_is_subscribed(self, author):
-        return (
-            not self.context['request'].user.is_anonymous
-            and Follow.objects.filter(
-                from_user=self.context['request'].user,
-                author=author).exists()
-        )
+        return author.id in get_followed_authors(self.context['request'])
 
 
 class AvatarSetSerializer(serializers.ModelSerializer):
     """Сериализирует картинку."""
 
-    avatar = Base64ImageField(required=True)
+    avatar = UploadedImageField(required=True)
 
     class Meta:
         model = User
         fields = ('avatar',)
 
+    def update(self, user, validated_data):
+        # Пока загрузка обрабатывается (avatar_status равен pending),
+        # аватаром служит сам загруженный файл
+        enqueue_image(
+            user, 'avatar', validated_data['avatar'], keep_upload=True
+        )
+        return user
+
 
 class TagSerializer(serializers.ModelSerializer):
     """Тэги."""
 
     class Meta:
         model = Tag
-        fields = '__all__'
+        fields = ('id', 'name', 'slug')
 
 
 class IngredientSerializer(serializers.ModelSerializer):
@@ -71,7 +123,7 @@ class IngredientSerializer(serializers.ModelSerializer):
 class IngredientInRecipeCreateSerializer(serializers.ModelSerializer):
     """Рецепты с продуктами и мерой."""
 
-    id = serializers.PrimaryKeyRelatedField(
+    id = BulkPrimaryKeyRelatedField(
         queryset=Ingredient.objects.all(), source='ingredient'
     )
     amount = serializers.IntegerField(min_value=MIN_AMOUNT)
@@ -79,6 +131,8 @@ class IngredientInRecipeCreateSerializer(serializers.ModelSerializer):
     class Meta:
         model = RecipeIngredient
         fields = ('id', 'amount')
+        # Продукты всего списка проверяются одним запросом
+        list_serializer_class = BulkRelatedListSerializer
 
 
 class IngredientInRecipeReadSerializer(serializers.ModelSerializer):
@@ -102,6 +156,7 @@ class RecipesReadSerializer(serializers.ModelSerializer):
         many=True, source='recipeingredients'
     )
     author = UserSerializer(read_only=True)
+    image_variants = ImageVariantsField('image')
     is_favorited = serializers.SerializerMethodField()
     is_in_shopping_cart = serializers.SerializerMethodField()
 
@@ -118,10 +173,15 @@ class RecipesReadSerializer(serializers.ModelSerializer):
             'text',
             'cooking_time',
             'image',
+            'image_variants',
+            'image_status',
         )
         read_only_fields = fields
 
-    def _favorite_shopping_methods(self, recipe, model):
+    def _favorite_shopping_methods(self, recipe, model, annotation):
+        # Флаг уже вычислен в запросе рецептов (см. RecipesViewSet)
+        if hasattr(recipe, annotation):
+            return getattr(recipe, annotation)
         return (
             not self.context['request'].user.is_anonymous
             and model.objects.filter(
@@ -131,17 +191,21 @@ class RecipesReadSerializer(serializers.ModelSerializer):
         )
 
     def get_is_favorited(self, recipe):
-        return self._favorite_shopping_methods(recipe, model=Favorite)
+        return self._favorite_shopping_methods(
+            recipe, model=Favorite, annotation='is_favorited')
 
     def get_is_in_shopping_cart(self, recipe):
         return self._favorite_shopping_methods(
-            recipe, model=ShoppingCart)
+            recipe, model=ShoppingCart, annotation='is_in_shopping_cart')
 
 
 class RecipesWriteSerializer(serializers.ModelSerializer):
 
-    image = Base64ImageField()
+    image = UploadedImageField()
     ingredients = IngredientInRecipeCreateSerializer(many=True)
+    tags = BulkPrimaryKeyRelatedField(
+        queryset=Tag.objects.all(), many=True, allow_empty=False
+    )
     cooking_time = serializers.IntegerField(min_value=MIN_COOKING_TIME)
 
     class Meta:
@@ -200,17 +264,56 @@ class RecipesWriteSerializer(serializers.ModelSerializer):
     @transaction.atomic
     def create(self, validated_data):
         ingredients = validated_data.pop('ingredients')
+        image = validated_data.pop('image')
         recipe = super().create(validated_data)
         self._set_recipe_ingredient(recipe=recipe, ingredients=ingredients)
+        enqueue_image(recipe, 'image', image)
         return recipe
 
+    def _update_recipe_ingredients(self, recipe, ingredients):
+        """
+        Приводит продукты рецепта к присланным по разнице с текущими:
+        новые добавляются, измененные меры обновляются, лишние удаляются,
+        совпадающие записи не трогаются. Изменения мер переносятся в
+        списки покупок.
+        """
+        amounts = {
+            item['ingredient'].id: item['amount'] for item in ingredients
+        }
+        deltas = dict(amounts)
+        changed, removed = [], []
+        for recipe_ingredient in recipe.recipeingredients.all():
+            ingredient_id = recipe_ingredient.ingredient_id
+            deltas[ingredient_id] = (
+                deltas.get(ingredient_id, 0) - recipe_ingredient.amount
+            )
+            amount = amounts.pop(ingredient_id, None)
+            if amount is None:
+                removed.append(recipe_ingredient.pk)
+            elif amount != recipe_ingredient.amount:
+                recipe_ingredient.amount = amount
+                changed.append(recipe_ingredient)
+        if removed:
+            RecipeIngredient.objects.filter(pk__in=removed).delete()
+        RecipeIngredient.objects.bulk_update(changed, ('amount',))
+        self._set_recipe_ingredient(recipe=recipe, ingredients=(
+            {'ingredient_id': ingredient_id, 'amount': amount}
+            for ingredient_id, amount in amounts.items()
+        ))
+        change_recipe(recipe.id, deltas)
+
+    @transaction.atomic
     def update(self, instance, validated_data):
-        ingredients = validated_data.pop('ingredients')
-        instance.recipeingredients.all().delete()
-        self._set_recipe_ingredient(
-            recipe=instance, ingredients=ingredients
+        # Теги ModelSerializer.update меняет через tags.set(): он тоже
+        # добавляет и удаляет только отличающиеся связи
+        self._update_recipe_ingredients(
+            instance, validated_data.pop('ingredients')
         )
-        return super().update(instance, validated_data)
+        image = validated_data.pop('image', None)
+        recipe = super().update(instance, validated_data)
+        if image:
+            enqueue_image(recipe, 'image', image)
+        return recipe
 
     def to_representation(self, recipe):
         return RecipesReadSerializer(recipe, context=self.context).data
@@ -218,16 +321,17 @@ class RecipesWriteSerializer(serializers.ModelSerializer):
 
 class ShortRecipesReadSerializer(serializers.ModelSerializer):
 
+    image_variants = ImageVariantsField('image')
+
     class Meta:
         model = Recipe
-        fields = ('id', 'name', 'image', 'cooking_time')
+        fields = ('id', 'name', 'image', 'image_variants', 'cooking_time')
         read_only_fields = fields
 
 
 class RecipesOfUserSerializer(UserSerializer):
 
     recipes = serializers.SerializerMethodField()
-    recipes_count = serializers.IntegerField(source='recipes.count')
 
     class Meta(UserSerializer.Meta):
         model = User
@@ -238,8 +342,9 @@ class RecipesOfUserSerializer(UserSerializer):
 
     def get_recipes(self, authors):
         return ShortRecipesReadSerializer(
+            # Для списка подписок рецепты уже ограничены в запросе к базе
             authors.recipes.all()[
-                :int(self.context['request'].GET.get('recipes_limit', 10**10))
+                :get_recipes_limit(self.context['request'])
             ],
             many=True
         ).data
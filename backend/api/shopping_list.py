@@ -0,0 +1,137 @@
+import csv
+import json
+from datetime import datetime
+
+from django.db.models import F
+from django.http import StreamingHttpResponse
+from django.utils.text import capfirst
+from rest_framework.renderers import JSONRenderer
+
+from recipes.models import Recipe, ShoppingListItem
+
+from .templatetags.date_filter import russian_months
+
+CSV_HEADER = ('Продукт', 'Единица измерения', 'Количество')
+CSV_RECIPES_HEADER = ('Рецепт', 'Автор')
+FILENAME = 'shopping_list_{:%d.%m.%Y}.{}'
+# Размер пачки строк, читаемых из базы при выгрузке
+CHUNK_SIZE = 500
+
+
+class TextShoppingListRenderer(JSONRenderer):
+    """
+    Рендереры списка покупок выбирают формат выгрузки по параметру
+    format или заголовку Accept. Сам список отдается потоком
+    (см. stream_shopping_list), рендереры оформляют только ошибки.
+    """
+
+    media_type = 'text/plain'
+    format = 'txt'
+    charset = 'utf-8'
+
+
+class CSVShoppingListRenderer(TextShoppingListRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+
+SHOPPING_LIST_RENDERERS = (
+    TextShoppingListRenderer, CSVShoppingListRenderer, JSONRenderer
+)
+
+
+def get_ingredients(user):
+    """Продукты корзины из уже суммированного списка покупок."""
+    return ShoppingListItem.objects.filter(user=user).values(
+        'ingredient__name',
+        'ingredient__measurement_unit',
+        total_amount=F('amount')
+    ).order_by(
+        'ingredient__name'
+    ).iterator(CHUNK_SIZE)
+
+
+def get_recipes(user):
+    """Рецепты корзины с авторами одним запросом."""
+    return Recipe.objects.filter(
+        shoppingcarts__user=user
+    ).values_list('name', 'author__username').order_by('name').iterator(
+        CHUNK_SIZE
+    )
+
+
+def render_txt(user, date):
+    yield f'Список покупок от {russian_months(date)}\n\nПродукты:\n'
+    for number, item in enumerate(get_ingredients(user), 1):
+        yield (
+            f'    {number}. {capfirst(item["ingredient__name"])} '
+            f'({item["ingredient__measurement_unit"]}): '
+            f'{item["total_amount"]}\n'
+        )
+    yield '\nДля рецептов:\n'
+    for name, author in get_recipes(user):
+        yield f'    (Автор: {author}) - {name}\n'
+
+
+class Echo:
+    """Файлоподобный объект для csv.writer: возвращает записанную строку."""
+
+    def write(self, value):
+        return value
+
+
+def render_csv(user, date):
+    """Таблица продуктов, затем через пустую строку таблица рецептов."""
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_HEADER)
+    for item in get_ingredients(user):
+        yield writer.writerow((
+            item['ingredient__name'],
+            item['ingredient__measurement_unit'],
+            item['total_amount'],
+        ))
+    yield writer.writerow(())
+    yield writer.writerow(CSV_RECIPES_HEADER)
+    for name, author in get_recipes(user):
+        yield writer.writerow((name, author))
+
+
+def render_json(user, date):
+    def dumps(value):
+        return json.dumps(value, ensure_ascii=False)
+
+    yield f'{{"date": {dumps(date.date().isoformat())}, "ingredients": ['
+    for number, item in enumerate(get_ingredients(user)):
+        yield ', ' * bool(number) + dumps({
+            'name': item['ingredient__name'],
+            'measurement_unit': item['ingredient__measurement_unit'],
+            'amount': item['total_amount'],
+        })
+    yield '], "recipes": ['
+    for number, (name, author) in enumerate(get_recipes(user)):
+        yield ', ' * bool(number) + dumps({'name': name, 'author': author})
+    yield ']}'
+
+
+RENDERERS = {
+    TextShoppingListRenderer.format: render_txt,
+    CSVShoppingListRenderer.format: render_csv,
+    JSONRenderer.format: render_json,
+}
+
+
+def stream_shopping_list(user, renderer):
+    """
+    Выгружает список покупок в формате рендерера. Продукты и рецепты
+    читаются двумя запросами пачками и отдаются построчно, поэтому
+    расход памяти не зависит от размера корзины.
+    """
+    date = datetime.now()
+    response = StreamingHttpResponse(
+        RENDERERS[renderer.format](user, date),
+        content_type=f'{renderer.media_type}; charset=utf-8'
+    )
+    response['Content-Disposition'] = (
+        f'attachment; filename="{FILENAME.format(date, renderer.format)}"'
+    )
+    return response
@@ -0,0 +1,62 @@
+import gzip
+from threading import Lock
+
+from django.http import HttpResponse
+from django.middleware.gzip import re_accepts_gzip
+from django.utils.cache import patch_vary_headers
+from rest_framework.renderers import JSONRenderer
+
+
+class CatalogSnapshot:
+    """Полный справочник, отрендеренный в JSON и сжатый gzip."""
+
+    def __init__(self, version, data):
+        self.version = version
+        self.body = JSONRenderer().render(data)
+        self.gzip_body = gzip.compress(self.body)
+
+
+_snapshots = {}
+_lock = Lock()
+
+
+def get_snapshot(view, table, version):
+    """
+    Возвращает снимок справочника для версии таблицы.
+    Снимок перестраивается только при смене версии.
+    """
+    snapshot = _snapshots.get(table)
+    if snapshot is not None and snapshot.version == version:
+        return snapshot
+    with _lock:
+        snapshot = _snapshots.get(table)
+        if snapshot is None or snapshot.version != version:
+            snapshot = _snapshots[table] = CatalogSnapshot(
+                version,
+                view.get_serializer(view.get_queryset(), many=True).data
+            )
+    return snapshot
+
+
+def accepts_gzip(request):
+    return bool(
+        re_accepts_gzip.search(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    )
+
+
+def snapshot_response(request, snapshot):
+    """
+    Отдает снимок без сериализации, сжатым, если клиент это принимает.
+    Сжатое и несжатое тела - разные байты, поэтому ETag снимка учитывает
+    кодировку (см. CatalogViewSet.get_validators).
+    """
+    if accepts_gzip(request):
+        response = HttpResponse(
+            snapshot.gzip_body, content_type='application/json'
+        )
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(snapshot.body, content_type='application/json')
+    response['Content-Length'] = len(response.content)
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
@@ -1,9 +1,35 @@
+import base64
+import gzip
+import json
+import os
+import shutil
+import tempfile
 from http import HTTPStatus
+from io import BytesIO, StringIO
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from PIL import Image
 from rest_framework.test import APIClient
 
+from api.search import ingredient_index
+from recipes.admin import get_cooking_time_histogram
+from recipes.models import (
+    Follow, ImageJob, Ingredient, Recipe, RecipeIngredient, ShoppingCart,
+    TableVersion, Tag
+)
+from recipes.short_links import decode, encode, recipe_exists
+
+RECIPES_URL = '/api/recipes/'
+USERS_URL = '/api/users/'
+INGREDIENTS_URL = '/api/ingredients/'
+
 
 class FoodgramAPITestCase(TestCase):
     def setUp(self):
@@ -16,3 +42,903 @@ class FoodgramAPITestCase(TestCase):
         """Проверка доступности списка рецептов."""
         response = self.client.get('/api/recipes/')
         self.assertEqual(response.status_code, HTTPStatus.OK)
+
+
+class RecipesDataTestCase(TestCase):
+    """Общие данные: авторы с рецептами, теги и продукты."""
+
+    RECIPES_NUMBER = 8
+
+    @classmethod
+    def setUpTestData(cls):
+        User = get_user_model()
+        tags = [
+            Tag.objects.create(name=f'Тэг {i}', slug=f'tag_{i}')
+            for i in range(3)
+        ]
+        ingredients = [
+            Ingredient.objects.create(
+                name=f'Продукт {i}', measurement_unit='г'
+            )
+            for i in range(3)
+        ]
+        for i in range(cls.RECIPES_NUMBER):
+            author = User.objects.create_user(
+                username=f'author_{i}', email=f'author_{i}@mail.ru'
+            )
+            recipe = Recipe.objects.create(
+                name=f'Рецепт {i}',
+                author=author,
+                text='Описание',
+                cooking_time=10,
+                image='recipes/image.png',
+            )
+            recipe.tags.set(tags)
+            RecipeIngredient.objects.bulk_create(
+                RecipeIngredient(
+                    recipe=recipe, ingredient=ingredient, amount=5
+                ) for ingredient in ingredients
+            )
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+
+class RecipesQueryCountTestCase(RecipesDataTestCase):
+
+    def _count_queries(self, limit):
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(RECIPES_URL, {'limit': limit})
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(len(response.data['results']), limit)
+        return len(context)
+
+    def test_recipes_list_query_count_is_constant(self):
+        """Число запросов списка рецептов не зависит от размера страницы."""
+        self.assertEqual(
+            self._count_queries(2),
+            self._count_queries(self.RECIPES_NUMBER)
+        )
+
+    def test_recipes_list_query_budget(self):
+        """Страница рецептов укладывается в фиксированное число запросов."""
+        # Версии таблиц, COUNT, рецепты с авторами, теги, продукты
+        with self.assertNumQueries(5):
+            self.client.get(RECIPES_URL, {'limit': self.RECIPES_NUMBER})
+        # Из кэша: без COUNT, тегов и продуктов
+        with self.assertNumQueries(2):
+            self.client.get(RECIPES_URL, {'limit': self.RECIPES_NUMBER})
+
+    def test_recipe_fragment_is_invalidated_on_ingredient_change(self):
+        """Изменение продуктов рецепта сбрасывает его кэшированный фрагмент."""
+        recipe = Recipe.objects.first()
+        url = f'{RECIPES_URL}{recipe.id}/'
+        self.client.get(url)
+        recipe_ingredient = recipe.recipeingredients.first()
+        recipe_ingredient.amount = 50
+        recipe_ingredient.save()
+        response = self.client.get(url)
+        self.assertIn(
+            50, [item['amount'] for item in response.data['ingredients']]
+        )
+
+    def test_authenticated_recipes_list_query_count_is_constant(self):
+        """Подписки на авторов проверяются одним запросом на страницу."""
+        user = get_user_model().objects.create_user(
+            username='reader', email='reader@mail.ru'
+        )
+        for author in get_user_model().objects.exclude(pk=user.pk)[:4]:
+            Follow.objects.create(from_user=user, author=author)
+        self.client.force_authenticate(user=user)
+        self.assertEqual(
+            self._count_queries(2),
+            self._count_queries(self.RECIPES_NUMBER)
+        )
+
+    def test_users_list_query_count_is_constant(self):
+        """Список пользователей не проверяет подписку на каждого отдельно."""
+        user = get_user_model().objects.create_user(
+            username='reader', email='reader@mail.ru'
+        )
+        self.client.force_authenticate(user=user)
+        query_counts = []
+        for limit in (2, self.RECIPES_NUMBER):
+            with CaptureQueriesContext(connection) as context:
+                self.client.get(USERS_URL, {'limit': limit})
+            query_counts.append(len(context))
+        self.assertEqual(*query_counts)
+
+
+class RecipesPaginationTestCase(RecipesDataTestCase):
+
+    def test_recipes_cursor_pagination(self):
+        """Режим курсора отдает все рецепты по порядку без подсчета."""
+        expected = list(Recipe.objects.values_list('id', flat=True))
+        received = []
+        url = RECIPES_URL + '?limit=3&cursor='
+        while url:
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(url)
+            self.assertNotIn('count', response.data)
+            self.assertFalse(any(
+                'COUNT(' in query['sql'] for query in context.captured_queries
+            ))
+            received.extend(
+                recipe['id'] for recipe in response.data['results']
+            )
+            previous, url = response.data['previous'], response.data['next']
+        self.assertEqual(received, expected)
+        response = self.client.get(previous)
+        self.assertEqual(
+            [recipe['id'] for recipe in response.data['results']],
+            expected[-5:-2]
+        )
+
+    def test_tampered_cursor_is_not_found(self):
+        """Курсор с чужими значениями позиции дает 404, а не ошибку."""
+        for position in ([1, 2], ['garbage', 'x'], [[], {}], [None, 1]):
+            cursor = base64.urlsafe_b64encode(
+                json.dumps({'p': position, 'r': 0}).encode()
+            ).decode()
+            response = self.client.get(RECIPES_URL, {'cursor': cursor})
+            self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
+
+    def test_recipes_count_is_cached_until_recipes_change(self):
+        """Число рецептов кэшируется и сбрасывается при их изменении."""
+        self.client.get(RECIPES_URL)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(RECIPES_URL)
+        self.assertTrue(response.data['count_is_exact'])
+        self.assertFalse(any(
+            'COUNT(' in query['sql'] for query in context.captured_queries
+        ))
+        with self.captureOnCommitCallbacks(execute=True):
+            Recipe.objects.first().delete()
+        response = self.client.get(RECIPES_URL)
+        self.assertEqual(response.data['count'], self.RECIPES_NUMBER - 1)
+
+
+class ConditionalGetTestCase(RecipesDataTestCase):
+
+    def test_recipe_conditional_get(self):
+        """Неизменившийся рецепт отдается ответом 304 без тела."""
+        user = get_user_model().objects.create_user(
+            username='reader', email='reader@mail.ru'
+        )
+        self.client.force_authenticate(user=user)
+        url = f'{RECIPES_URL}{Recipe.objects.first().id}/'
+        etag = self.client.get(url)['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, HTTPStatus.NOT_MODIFIED)
+        self.assertFalse(response.content)
+        self.client.post(f'{url}favorite/')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertTrue(response.data['is_favorited'])
+
+    def test_lists_are_invalidated_by_users_and_subscriptions(self):
+        """Подписка и новый пользователь меняют ETag списков."""
+        user = get_user_model().objects.create_user(
+            username='reader', email='reader@mail.ru'
+        )
+        self.client.force_authenticate(user=user)
+        recipes_etag = self.client.get(RECIPES_URL)['ETag']
+        users_etag = self.client.get(USERS_URL)['ETag']
+        author = Recipe.objects.first().author
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f'{USERS_URL}{author.id}/subscribe/')
+        response = self.client.get(
+            RECIPES_URL, HTTP_IF_NONE_MATCH=recipes_etag
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertTrue(any(
+            recipe['author']['is_subscribed']
+            for recipe in response.data['results']
+        ))
+        with self.captureOnCommitCallbacks(execute=True):
+            get_user_model().objects.create_user(
+                username='newcomer', email='newcomer@mail.ru'
+            )
+        self.assertEqual(
+            self.client.get(
+                USERS_URL, HTTP_IF_NONE_MATCH=users_etag
+            ).status_code,
+            HTTPStatus.OK
+        )
+
+    def test_login_does_not_invalidate_lists(self):
+        """Вход пользователя (обновление last_login) не меняет ETag."""
+        user = get_user_model().objects.create_user(
+            username='reader', email='reader@mail.ru', password='Pass-1234'
+        )
+        recipes_etag = self.client.get(RECIPES_URL)['ETag']
+        users_etag = self.client.get(USERS_URL)['ETag']
+        response = self.client.post('/api/auth/token/login/', {
+            'email': user.email, 'password': 'Pass-1234'
+        })
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        user.refresh_from_db()
+        self.assertIsNotNone(user.last_login)
+        for url, etag in (
+            (RECIPES_URL, recipes_etag), (USERS_URL, users_etag)
+        ):
+            self.assertEqual(
+                self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code,
+                HTTPStatus.NOT_MODIFIED
+            )
+
+    def test_user_with_invalid_id_is_not_found(self):
+        """Нечисловой id пользователя дает 404, а не ошибку сервера."""
+        response = self.client.get(f'{USERS_URL}abc/')
+        self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
+
+
+class CountersTestCase(RecipesDataTestCase):
+
+    def test_counters_follow_favorites_and_subscriptions(self):
+        """Счетчики обновляются при добавлении и удалении записей."""
+        user = get_user_model().objects.create_user(
+            username='reader', email='reader@mail.ru'
+        )
+        self.client.force_authenticate(user=user)
+        recipe = Recipe.objects.first()
+        self.client.post(f'{RECIPES_URL}{recipe.id}/favorite/')
+        response = self.client.post(
+            f'{USERS_URL}{recipe.author.id}/subscribe/'
+        )
+        self.assertEqual(response.data['recipes_count'], 1)
+        recipe.refresh_from_db()
+        user.refresh_from_db()
+        self.assertEqual(recipe.favorites_count, 1)
+        self.assertEqual(user.subscriptions_count, 1)
+        self.assertEqual(recipe.author.subscribers_count, 1)
+        self.client.delete(f'{RECIPES_URL}{recipe.id}/favorite/')
+        recipe.refresh_from_db()
+        self.assertEqual(recipe.favorites_count, 0)
+
+    def test_rebuild_denormalized_repairs_counters(self):
+        """Команда пересчета исправляет рассинхронизированные счетчики."""
+        get_user_model().objects.update(recipes_count=0)
+        call_command('rebuild_denormalized', stdout=StringIO())
+        self.assertFalse(
+            get_user_model().objects.filter(
+                recipes__isnull=False, recipes_count=0
+            ).exists()
+        )
+
+
+class TagFilterTestCase(RecipesDataTestCase):
+
+    def test_tags_filter_uses_mask(self):
+        """Фильтр по тегам сверяет маски без соединения и DISTINCT."""
+        first, second = Recipe.objects.all()[:2]
+        tag_0, tag_1, tag_2 = Tag.objects.order_by('slug')
+        first.tags.set([tag_0])
+        tag_1.recipes.remove(second)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(
+                RECIPES_URL, {'tags': ['tag_0', 'tag_1'], 'limit': 10}
+            )
+        self.assertEqual(response.data['count'], self.RECIPES_NUMBER)
+        self.assertFalse(any(
+            'DISTINCT' in query['sql'] for query in context.captured_queries
+        ))
+        response = self.client.get(
+            RECIPES_URL, {'tags_all': ['tag_0', 'tag_1'], 'limit': 10}
+        )
+        self.assertEqual(response.data['count'], self.RECIPES_NUMBER - 2)
+        tag_2.delete()
+        Recipe.objects.filter(pk=second.pk).update(tags_mask=0)
+        call_command('rebuild_denormalized', stdout=StringIO())
+        self.assertEqual(
+            set(Recipe.objects.values_list('tags_mask', flat=True)),
+            {tag_0.mask, tag_0.mask | tag_1.mask}
+        )
+
+    def test_tag_facets(self):
+        """Счетчики по тегам считаются одним запросом и кэшируются."""
+        first = Recipe.objects.first()
+        first.tags.set(Tag.objects.filter(slug='tag_0'))
+        params = {'facets': 'tags', 'author': first.author_id}
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(RECIPES_URL, params)
+        facets = {
+            tag['slug']: tag['count']
+            for tag in response.data['facets']['tags']
+        }
+        self.assertEqual(facets, {'tag_0': 1, 'tag_1': 0, 'tag_2': 0})
+        with CaptureQueriesContext(connection) as cached_context:
+            self.client.get(RECIPES_URL, params)
+        for captured, expected in ((context, 1), (cached_context, 0)):
+            self.assertEqual(expected, sum(
+                'GROUP BY' in query['sql']
+                for query in captured.captured_queries
+            ))
+        response = self.client.get(RECIPES_URL, {'facets': 'authors'})
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+
+class ShoppingListTestCase(RecipesDataTestCase):
+
+    def test_download_shopping_cart_formats(self):
+        """Список покупок выгружается потоком фиксированным числом запросов."""
+        user = get_user_model().objects.create_user(
+            username='reader', email='reader@mail.ru'
+        )
+        for recipe in Recipe.objects.all()[:3]:
+            ShoppingCart.objects.create(user=user, recipe=recipe)
+        self.client.force_authenticate(user=user)
+        url = f'{RECIPES_URL}download_shopping_cart/'
+        # Продукты и рецепты
+        for export, content_type in (
+            ('txt', 'text/plain'), ('csv', 'text/csv'),
+            ('json', 'application/json')
+        ):
+            with self.assertNumQueries(2):
+                response = self.client.get(url, {'format': export})
+                content = b''.join(response.streaming_content).decode()
+            self.assertTrue(response['Content-Type'].startswith(content_type))
+            self.assertIn(f'.{export}"', response['Content-Disposition'])
+            self.assertIn('Продукт 0', content)
+            self.assertIn(recipe.author.username, content)
+        self.assertEqual(json.loads(content)['ingredients'][0]['amount'], 15)
+        response = self.client.get(url)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+
+    def test_shopping_list_follows_cart_and_recipe_changes(self):
+        """Сводный список покупок меняется вместе с корзиной и рецептами."""
+        user = get_user_model().objects.create_user(
+            username='reader', email='reader@mail.ru'
+        )
+        first, second = Recipe.objects.all()[:2]
+        ingredient = Ingredient.objects.get(name='Продукт 0')
+
+        def amounts():
+            return dict(user.shoppinglistitems.values_list(
+                'ingredient__name', 'amount'
+            ))
+
+        self.client.force_authenticate(user=user)
+        for recipe in (first, second):
+            self.client.post(f'{RECIPES_URL}{recipe.id}/shopping_cart/')
+        self.assertEqual(amounts(), {
+            f'Продукт {i}': 10 for i in range(3)
+        })
+        self.client.force_authenticate(user=first.author)
+        response = self.client.patch(f'{RECIPES_URL}{first.id}/', {
+            'ingredients': [{'id': ingredient.id, 'amount': 7}],
+            'tags': list(first.tags.values_list('id', flat=True)),
+        }, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(amounts(), {
+            'Продукт 0': 12, 'Продукт 1': 5, 'Продукт 2': 5
+        })
+        second.delete()
+        self.assertEqual(amounts(), {'Продукт 0': 7})
+        user.shoppinglistitems.update(amount=1)
+        call_command('rebuild_denormalized', stdout=StringIO())
+        self.assertEqual(amounts(), {'Продукт 0': 7})
+        ShoppingCart.objects.filter(user=user).delete()
+        self.assertEqual(amounts(), {})
+
+
+class RecipeWriteTestCase(RecipesDataTestCase):
+
+    def test_table_version_changes_once_after_commit(self):
+        """Версия таблицы меняется после фиксации, один раз за транзакцию."""
+        recipe = Recipe.objects.first()
+        self.assertGreater(recipe.recipeingredients.count(), 1)
+        version = TableVersion.get_versions('recipe')['recipe']
+        with self.captureOnCommitCallbacks(execute=True):
+            recipe.delete()
+            self.assertEqual(
+                TableVersion.get_versions('recipe')['recipe'], version
+            )
+        self.assertEqual(
+            TableVersion.get_versions('recipe')['recipe'], version + 1
+        )
+
+    def test_recipe_update_changes_only_differing_ingredients(self):
+        """Обновление рецепта не пересоздает неизмененные продукты."""
+        recipe = Recipe.objects.first()
+        kept, changed, removed = recipe.recipeingredients.order_by('pk')
+        added = Ingredient.objects.create(name='Новый', measurement_unit='г')
+        self.client.force_authenticate(user=recipe.author)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.patch(f'{RECIPES_URL}{recipe.id}/', {
+                'ingredients': [
+                    {'id': kept.ingredient_id, 'amount': kept.amount},
+                    {'id': changed.ingredient_id, 'amount': 9},
+                    {'id': added.id, 'amount': 3},
+                ],
+                'tags': list(recipe.tags.values_list('id', flat=True)),
+            }, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        rows = {
+            row['ingredient']: (row['pk'], row['amount'])
+            for row in recipe.recipeingredients.values(
+                'pk', 'ingredient', 'amount'
+            )
+        }
+        self.assertEqual(rows[kept.ingredient_id], (kept.pk, kept.amount))
+        self.assertEqual(rows[changed.ingredient_id], (changed.pk, 9))
+        self.assertEqual(rows[added.id][1], 3)
+        self.assertNotIn(removed.ingredient_id, rows)
+        self.assertFalse(any(
+            query['sql'].startswith('DELETE FROM "recipes_recipe_tags"')
+            for query in context.captured_queries
+        ))
+
+    def test_recipe_ids_are_validated_in_bulk(self):
+        """Продукты и теги проверяются одним запросом, ошибки - все сразу."""
+        self.client.force_authenticate(user=Recipe.objects.first().author)
+        ingredient_ids = list(Ingredient.objects.values_list('id', flat=True))
+        tag_ids = list(Tag.objects.values_list('id', flat=True))
+
+        def post(ingredients, tags):
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.post(RECIPES_URL, {
+                    'ingredients': [
+                        {'id': pk, 'amount': 1} for pk in ingredients
+                    ],
+                    'tags': tags,
+                    'name': 'Рецепт', 'text': 'Описание', 'cooking_time': 1,
+                }, format='json')
+            self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+            return response.data, len(context)
+
+        errors, few_queries = post(ingredient_ids[:1], tag_ids[:1])
+        errors, many_queries = post(
+            [*ingredient_ids, 998, 999], [*tag_ids, 998, 999]
+        )
+        self.assertEqual(few_queries, many_queries)
+        self.assertEqual(
+            [bool(item) for item in errors['ingredients']],
+            [False] * len(ingredient_ids) + [True, True]
+        )
+        self.assertEqual(len(errors['tags']), 2)
+        self.assertIn('998', errors['tags'][0])
+
+
+class QueryPlansTestCase(RecipesDataTestCase):
+
+    def test_hot_queries_use_indexes(self):
+        """Частые запросы читают таблицы по индексам."""
+        call_command(
+            'check_query_plans', recipes=500, users=20, ingredients=100,
+            stdout=StringIO()
+        )
+        self.assertFalse(Recipe.objects.filter(text='plan-check').exists())
+
+
+class SubscriptionsTestCase(RecipesDataTestCase):
+
+    def test_subscriptions_recipes_limit(self):
+        """Лимит рецептов автора в подписках применяется в базе."""
+        user = get_user_model().objects.create_user(
+            username='reader', email='reader@mail.ru'
+        )
+        author = Recipe.objects.first().author
+        for i in range(2):
+            Recipe.objects.create(
+                name=f'Еще рецепт {i}', author=author, text='Описание',
+                cooking_time=5, image='recipes/image.png'
+            )
+        Follow.objects.create(from_user=user, author=author)
+        self.client.force_authenticate(user=user)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(
+                f'{USERS_URL}subscriptions/', {'recipes_limit': 2}
+            )
+        self.assertTrue(any(
+            'ROW_NUMBER()' in query['sql']
+            for query in context.captured_queries
+        ))
+        subscription = response.data['results'][0]
+        self.assertEqual(subscription['recipes_count'], 3)
+        self.assertEqual(
+            [recipe['id'] for recipe in subscription['recipes']],
+            list(author.recipes.values_list('id', flat=True)[:2])
+        )
+        response = self.client.get(
+            f'{USERS_URL}subscriptions/', {'recipes_limit': 'много'}
+        )
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+
+class IngredientSearchTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        for name in (
+            'соль', 'морская соль', 'фасоль', 'сахар', 'Соль крупная'
+        ):
+            Ingredient.objects.create(name=name, measurement_unit='г')
+
+    def test_search_ranking_and_no_queries(self):
+        """Сначала совпадения в начале названия, затем вхождения."""
+        # Индекс общий для процесса: перестроим его по данным теста
+        ingredient_index.version = None
+        ingredient_index.invalidate()
+        client = APIClient()
+        client.get(INGREDIENTS_URL, {'name': 'сол'})
+        with self.assertNumQueries(0):
+            response = client.get(INGREDIENTS_URL, {'name': 'Сол'})
+        self.assertEqual(
+            [item['name'] for item in response.data],
+            ['соль', 'Соль крупная', 'морская соль', 'фасоль']
+        )
+        # Пробелы по краям запроса не учитываются
+        response = client.get(INGREDIENTS_URL, {'name': ' сол '})
+        self.assertEqual(len(response.data), 4)
+        response = client.get(INGREDIENTS_URL, {'name': ' '})
+        self.assertEqual(len(response.data), 5)
+
+    def test_catalog_snapshot(self):
+        """Полный справочник отдается снимком, в том числе сжатым."""
+        client = APIClient()
+        response = client.get(INGREDIENTS_URL)
+        self.assertIn('public', response['Cache-Control'])
+        self.assertEqual(len(json.loads(response.content)), 5)
+        with self.assertNumQueries(1):
+            compressed = client.get(
+                INGREDIENTS_URL, HTTP_ACCEPT_ENCODING='gzip'
+            )
+        self.assertEqual(compressed['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(compressed.content), response.content)
+        self.assertNotEqual(compressed['ETag'], response['ETag'])
+        self.assertEqual(
+            client.get(
+                INGREDIENTS_URL, HTTP_IF_NONE_MATCH=response['ETag'],
+                HTTP_ACCEPT_ENCODING='gzip'
+            ).status_code,
+            HTTPStatus.OK
+        )
+
+
+class AdminQueryCountTestCase(TestCase):
+
+    def setUp(self):
+        self.admin = get_user_model().objects.create_superuser(
+            username='admin', email='admin@mail.ru', password='password'
+        )
+        self.client.force_login(self.admin)
+        self.tags = [
+            Tag.objects.create(name=f'Тэг {i}', slug=f'tag-{i}')
+            for i in range(2)
+        ]
+        self.ingredients = [
+            Ingredient.objects.create(
+                name=f'Продукт {i}', measurement_unit='г'
+            ) for i in range(3)
+        ]
+
+    def create_recipes(self, count):
+        for i in range(count):
+            recipe = Recipe.objects.create(
+                name=f'Рецепт {i}', text='Описание', cooking_time=i + 1,
+                image='recipes/image.png',
+                author=get_user_model().objects.create_user(
+                    username=f'author-{count}-{i}',
+                    email=f'author-{count}-{i}@mail.ru'
+                ),
+            )
+            recipe.tags.set(self.tags)
+            RecipeIngredient.objects.bulk_create(
+                RecipeIngredient(recipe=recipe, ingredient=ingredient,
+                                 amount=1)
+                for ingredient in self.ingredients
+            )
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        return len(context.captured_queries)
+
+    def test_recipe_changelist(self):
+        """Число запросов списка рецептов не зависит от числа строк."""
+        url = '/admin/recipes/recipe/'
+        self.create_recipes(3)
+        queries = self.count_queries(url)
+        self.create_recipes(7)
+        self.assertEqual(self.count_queries(url), queries)
+
+    def test_recipe_change_page(self):
+        """Страница рецепта выводит только его продукты без N+1."""
+        self.create_recipes(2)
+        first, second = Recipe.objects.order_by('id')
+        RecipeIngredient.objects.bulk_create(
+            RecipeIngredient(
+                recipe=second, amount=1, ingredient=Ingredient.objects.create(
+                    name=f'Еще продукт {i}', measurement_unit='шт'
+                )
+            ) for i in range(7)
+        )
+        first_url = f'/admin/recipes/recipe/{first.id}/change/'
+        self.count_queries(first_url)
+        queries = self.count_queries(first_url)
+        second_url = f'/admin/recipes/recipe/{second.id}/change/'
+        self.assertEqual(self.count_queries(second_url), queries)
+        self.assertNotIn(
+            'Еще продукт', self.client.get(first_url).content.decode()
+        )
+        self.assertIn(
+            'Еще продукт 6 (шт)', self.client.get(second_url).content.decode()
+        )
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(
+                '/admin/recipes/ingredient/autocomplete/', {
+                    'term': 'Еще продукт 6', 'app_label': 'recipes',
+                    'model_name': 'recipeingredient',
+                    'field_name': 'ingredient',
+                }
+            )
+        # Поиск не считает рецепты каждого продукта
+        for query in context.captured_queries:
+            self.assertNotIn('GROUP BY', query['sql'])
+            self.assertNotIn('recipes_recipeingredient', query['sql'])
+        self.assertEqual(
+            [item['text'] for item in response.json()['results']],
+            ['Еще продукт 6 (шт)']
+        )
+
+    def test_counts_and_filters(self):
+        """Списки тегов, продуктов и пользователей без запросов на строку."""
+        self.create_recipes(1)
+        Follow.objects.create(
+            from_user=self.admin, author=Recipe.objects.get().author
+        )
+        urls = (
+            '/admin/recipes/tag/', '/admin/recipes/ingredient/',
+            '/admin/recipes/user/',
+        )
+        queries = [self.count_queries(url) for url in urls]
+        self.create_recipes(4)
+        Ingredient.objects.create(name='Без рецептов', measurement_unit='г')
+        self.assertEqual([self.count_queries(url) for url in urls], queries)
+        response = self.client.get('/admin/recipes/tag/')
+        self.assertEqual(
+            [tag.recipes_total for tag in response.context['cl'].result_list],
+            [5, 5]
+        )
+        # Рецепты считаются подзапросом для строк страницы, без GROUP BY
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(f'{urls[1]}?o=-4')
+        self.assertFalse(any(
+            'GROUP BY "recipes_ingredient"' in query['sql']
+            for query in context.captured_queries
+        ))
+        self.assertEqual(
+            [
+                ingredient.recipes_total
+                for ingredient in response.context['cl'].result_list
+            ][-1],
+            0
+        )
+        for url, filters, expected in (
+            (urls[1], 'has_recipes=no', {'Без рецептов'}),
+            (urls[2], 'has_recipes=no', {'admin'}),
+            (urls[2], 'followers=yes', {'admin'}),
+            (urls[2], 'subscriptions=yes', {'author-1-0'}),
+        ):
+            with self.subTest(url=url, filters=filters):
+                self.assertEqual(
+                    {str(obj) for obj in self.client.get(
+                        f'{url}?{filters}'
+                    ).context['cl'].result_list},
+                    expected
+                )
+
+    def test_cooking_time_histogram(self):
+        """Гистограмма совпадает с numpy.histogram и кэшируется."""
+        cache.clear()
+        self.assertIsNone(get_cooking_time_histogram())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_recipes(4)
+        self.assertEqual(
+            get_cooking_time_histogram(), ([1, 1, 2], [1, 2, 3, 4])
+        )
+        with self.assertNumQueries(1):
+            get_cooking_time_histogram()
+        Recipe.objects.filter(cooking_time=4).update(cooking_time=10)
+        with self.captureOnCommitCallbacks(execute=True):
+            Recipe.objects.first().save()
+        self.assertEqual(
+            get_cooking_time_histogram(), ([3, 0, 1], [1, 4, 7, 10])
+        )
+
+
+class ShortLinkTestCase(TestCase):
+
+    def setUp(self):
+        recipe_exists.clear()
+        self.recipe = Recipe.objects.create(
+            name='Рецепт', text='Описание', cooking_time=10,
+            image='recipes/image.png',
+            author=get_user_model().objects.create_user(username='author'),
+        )
+
+    def test_short_code(self):
+        """Коды base62 обратимы, а переходы по ним идут через кэш."""
+        for number in (0, 9, 61, 62, 10 ** 12):
+            self.assertEqual(decode(encode(number)), number)
+        self.assertIsNone(decode('0a'))
+        link = self.client.get(
+            f'{RECIPES_URL}{self.recipe.id}/get-link/'
+        ).data['short-link']
+        self.assertTrue(link.endswith(f'/r/{encode(self.recipe.id)}/'))
+        with self.assertNumQueries(0):
+            response = self.client.get(link)
+        self.assertRedirects(
+            response, f'/recipes/{self.recipe.id}/',
+            fetch_redirect_response=False
+        )
+        self.assertIn('max-age', response['Cache-Control'])
+        # Старые ссылки по id продолжают работать
+        self.assertEqual(
+            self.client.get(f'/s/{self.recipe.id}/').status_code,
+            HTTPStatus.FOUND
+        )
+        missing = f'/r/{encode(self.recipe.id + 1)}/'
+        self.assertEqual(
+            self.client.get(missing).status_code, HTTPStatus.NOT_FOUND
+        )
+        with self.assertNumQueries(0):
+            self.client.get(missing)
+        self.recipe.delete()
+        self.assertEqual(
+            self.client.get(link).status_code, HTTPStatus.NOT_FOUND
+        )
+
+
+@override_settings(
+    MEDIA_ROOT=tempfile.mkdtemp(), IMAGE_UPLOAD_ROOT=tempfile.mkdtemp(),
+    IMAGE_MAX_SIZE=100, IMAGE_CARD_SIZE=60, IMAGE_THUMBNAIL_SIZE=20
+)
+class ImageProcessingTestCase(TestCase):
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+        shutil.rmtree(settings.IMAGE_UPLOAD_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        self.author = get_user_model().objects.create_user(
+            username='author', email='author@mail.ru'
+        )
+        self.tag = Tag.objects.create(name='Тэг', slug='tag')
+        self.ingredient = Ingredient.objects.create(
+            name='Продукт', measurement_unit='г'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.author)
+
+    def post_recipe(self, content):
+        return self.client.post(RECIPES_URL, {
+            'ingredients': [{'id': self.ingredient.id, 'amount': 1}],
+            'tags': [self.tag.id],
+            'name': 'Рецепт', 'text': 'Описание', 'cooking_time': 1,
+            'image': 'data:image/jpeg;base64,'
+                     + base64.b64encode(content).decode(),
+        }, format='json')
+
+    def test_image_is_processed_outside_request(self):
+        """Запрос только ставит задание, обработчик перекодирует файл."""
+        exif = Image.Exif()
+        exif[0x010F] = 'Камера'
+        upload = BytesIO()
+        Image.new('RGB', (400, 200), 'red').save(upload, 'JPEG', exif=exif)
+        response = self.post_recipe(upload.getvalue())
+        self.assertEqual(response.status_code, HTTPStatus.CREATED)
+        self.assertEqual(response.data['image_status'], 'pending')
+        self.assertIsNone(response.data['image'])
+        source = ImageJob.objects.get().source
+        call_command('process_images', once=True, stdout=StringIO())
+        recipe = Recipe.objects.get(pk=response.data['id'])
+        self.assertEqual(recipe.image_status, 'ready')
+        with Image.open(recipe.image.path) as image:
+            self.assertEqual(image.size, (100, 50))
+            self.assertFalse(image.getexif())
+        self.assertFalse(ImageJob.objects.exists())
+        self.assertFalse(os.path.exists(source.path))
+
+    def test_image_variants(self):
+        """Варианты WebP создаются при обработке и командой для старых."""
+        upload = BytesIO()
+        Image.new('RGB', (400, 200), 'red').save(upload, 'PNG')
+        response = self.post_recipe(upload.getvalue())
+        call_command('process_images', once=True, stdout=StringIO())
+        recipe = Recipe.objects.get(pk=response.data['id'])
+        self.assertTrue(recipe.image_variants)
+        variants = self.client.get(
+            f'{RECIPES_URL}{recipe.id}/'
+        ).data['image_variants']
+        for variant, width in (('thumbnail', 20), ('card', 60), ('full', 100)):
+            self.assertTrue(variants[variant].endswith(f'.{variant}.webp'))
+            path = os.path.join(
+                settings.MEDIA_ROOT, variants[variant].split(
+                    settings.MEDIA_URL, 1
+                )[1]
+            )
+            with Image.open(path) as image:
+                self.assertEqual((image.format, image.width), ('WEBP', width))
+        Recipe.objects.filter(pk=recipe.pk).update(image_variants=False)
+        cache.clear()
+        self.assertEqual(
+            self.client.get(f'{RECIPES_URL}{recipe.id}/').data[
+                'image_variants'
+            ]['thumbnail'],
+            response.wsgi_request.build_absolute_uri(recipe.image.url)
+        )
+        call_command('make_image_variants', stdout=StringIO())
+        recipe.refresh_from_db()
+        self.assertTrue(recipe.image_variants)
+
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=10)
+    def test_multipart_upload(self):
+        """Рецепт и аватар принимаются и файлом в multipart/form-data."""
+        upload = BytesIO()
+        Image.new('RGB', (40, 20), 'red').save(upload, 'JPEG')
+
+        def image_file():
+            return SimpleUploadedFile(
+                'photo.bin', upload.getvalue(), 'application/octet-stream'
+            )
+
+        response = self.client.post(RECIPES_URL, {
+            'ingredients[0]id': self.ingredient.id,
+            'ingredients[0]amount': 2,
+            'tags': [self.tag.id],
+            'name': 'Рецепт', 'text': 'Описание', 'cooking_time': 1,
+            'image': image_file(),
+        }, format='multipart')
+        self.assertEqual(response.status_code, HTTPStatus.CREATED)
+        self.assertEqual(response.data['ingredients'][0]['amount'], 2)
+        self.assertTrue(ImageJob.objects.get().source.name.endswith('.jpg'))
+        response = self.client.put(
+            f'{USERS_URL}me/avatar/', {'avatar': image_file()},
+            format='multipart'
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        # До обработки аватаром служит загруженный файл
+        uploaded = response.data['avatar']
+        self.assertTrue(uploaded.startswith('http'))
+        self.assertEqual(
+            self.client.get(f'{USERS_URL}me/').data['avatar_status'],
+            'pending'
+        )
+        call_command('process_images', once=True, stdout=StringIO())
+        self.assertEqual(Recipe.objects.get().image_status, 'ready')
+        self.author.refresh_from_db()
+        self.assertTrue(self.author.avatar)
+        self.assertNotIn(self.author.avatar.name, uploaded)
+        self.assertEqual(self.author.avatar_status, 'ready')
+        response = self.client.get(f'{USERS_URL}me/')
+        self.assertEqual(response.data['avatar_status'], 'ready')
+        self.assertTrue(response.data['avatar'])
+        response = self.client.put(f'{USERS_URL}me/avatar/', {
+            'avatar': 'data:image/jpeg;base64,'
+                      + base64.b64encode(upload.getvalue()).decode()
+        }, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(list(response.data), ['avatar'])
+        self.assertTrue(response.data['avatar'])
+        response = self.client.put(f'{USERS_URL}me/avatar/', {
+            'avatar': SimpleUploadedFile('notes.txt', b'not an image')
+        }, format='multipart')
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+    def test_broken_image_fails_processing(self):
+        """Файл, который не удалось разобрать, помечается ошибкой."""
+        response = self.post_recipe(b'\xff\xd8\xff\xe0' + b'0' * 64)
+        self.assertEqual(response.status_code, HTTPStatus.CREATED)
+        call_command('process_images', once=True, stdout=StringIO())
+        recipe = Recipe.objects.get(pk=response.data['id'])
+        self.assertEqual(recipe.image_status, 'failed')
+        self.assertEqual(
+            ImageJob.objects.get().status, ImageJob.Status.FAILED
+        )
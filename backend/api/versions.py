@@ -0,0 +1,31 @@
+from recipes.models import TableVersion
+
+TABLE_STATE_ATTRIBUTE = '_table_state'
+
+
+def get_table_state(request, *names):
+    """
+    Версии таблиц и время последнего изменения любой из них
+    (см. TableVersion.get_state). Таблица версий мала, поэтому читается
+    целиком одним запросом и запоминается в объекте запроса: пагинация,
+    кэш фрагментов и условные запросы обходятся этим одним запросом.
+    """
+    if not hasattr(request, TABLE_STATE_ATTRIBUTE):
+        setattr(request, TABLE_STATE_ATTRIBUTE, {
+            name: (version, updated_at)
+            for name, version, updated_at in TableVersion.objects.values_list(
+                'name', 'version', 'updated_at'
+            )
+        })
+    state = getattr(request, TABLE_STATE_ATTRIBUTE)
+    return (
+        {name: state.get(name, (0, None))[0] for name in names},
+        max(
+            (state[name][1] for name in names if name in state),
+            default=None
+        )
+    )
+
+
+def get_table_versions(request, *names):
+    return get_table_state(request, *names)[0]
@@ -1,10 +1,10 @@
-from datetime import datetime
-
 from django.conf import settings
-from django.db.models import Prefetch, Sum
-from django.http import FileResponse
+from django.db.models import (
+    BooleanField, Exists, F, OuterRef, Prefetch, Value, Window
+)
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import RowNumber
 from django.shortcuts import get_object_or_404
-from django.template.loader import render_to_string
 from django.urls import reverse
 from django_filters.rest_framework import DjangoFilterBackend
 from djoser.views import UserViewSet as UserViewSetDjoser
@@ -19,21 +19,35 @@ from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
 
 from api.permissions import IsAuthorOrReadOnly
 from recipes.constants import RECIPE_NOT_FOUND
+from recipes.images import ImageStatus, discard_pending_jobs, set_image_status
 from recipes.models import (
-    Favorite, Follow, Ingredient, Recipe, RecipeIngredient, ShoppingCart, Tag,
-    User
+    Favorite, Follow, Ingredient, Recipe, ShoppingCart, Tag, User
 )
+from recipes.short_links import encode, recipe_exists
 
+from .conditional import (
+    PRIVATE_CACHE_CONTROL, conditional_get, make_etag, normalize_query
+)
+from .facets import (
+    FACETS_PARAM, TAGS_FACET, get_requested_facets, get_tag_facets
+)
 from .filters import IngredientFilter, RecipeFilter
+from .fragments import FRAGMENT_TABLES, serialize_recipes
+from .search import ingredient_index
 from .serializers import (
     AvatarSetSerializer, IngredientSerializer, RecipesOfUserSerializer,
     RecipesReadSerializer, RecipesWriteSerializer, ShortRecipesReadSerializer,
-    TagSerializer, UserSerializer
+    TagSerializer, UserSerializer, get_followed_authors, get_recipes_limit
 )
+from .shopping_list import SHOPPING_LIST_RENDERERS, stream_shopping_list
+from .snapshots import accepts_gzip, get_snapshot, snapshot_response
+from .versions import get_table_state
 
 FOLLOWING_ERROR = 'Подписка на {} уже есть!'
 RECORD_ERROR = 'Запись рецепта с id {} в модели {} уже есть в базе!'
 SELF_FOLLOWING = 'Нельзя подписаться на самого себя!'
+# Таблицы, от которых зависит персональная часть ответа
+PERSONAL_TABLES = ('favorite', 'shoppingcart', 'follow')
 
 
 class UserViewSet(UserViewSetDjoser):
@@ -44,12 +58,49 @@ class UserViewSet(UserViewSetDjoser):
     serializer_class = UserSerializer
     http_method_names = ('get', 'post', 'put', 'delete')
 
+    def get_validators(self, request, *args, **kwargs):
+        """Валидаторы условных запросов к профилям пользователей."""
+        if self.action == 'get_me_data':
+            return (
+                make_etag(request.user.pk, request.user.updated_at),
+                request.user.updated_at
+            )
+        if self.action == 'retrieve':
+            try:
+                user_id = int(kwargs['id'])
+            except ValueError:
+                # Ответ 404 вернет get_object
+                return None, None
+            updated_at = User.objects.filter(pk=user_id).values_list(
+                'updated_at', flat=True
+            ).first()
+            if updated_at is None:
+                return None, None
+            return make_etag(
+                user_id,
+                updated_at,
+                user_id in get_followed_authors(request)
+            ), updated_at
+        versions, last_modified = get_table_state(request, 'user', 'follow')
+        return make_etag(
+            versions, request.user.pk, normalize_query(request)
+        ), last_modified
+
+    @conditional_get
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @conditional_get
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
     @action(
         detail=False,
         methods=['GET'],
         url_path=settings.SELF_PROFILE_POINT,
         permission_classes=(IsAuthenticated,)
     )
+    @conditional_get
     def get_me_data(self, request):
         """Получение своей учетной записи."""
         return Response(
@@ -68,11 +119,16 @@ class UserViewSet(UserViewSetDjoser):
     def set_or_delete_avatar(self, request):
         """Установка или удаление аватарки пользователя."""
         if request.method != 'PUT':
-            request.user.avatar.delete(save=True)
+            discard_pending_jobs(request.user, 'avatar')
+            request.user.avatar.delete(save=False)
+            set_image_status(
+                request.user, 'avatar', ImageStatus.READY, 'avatar'
+            )
             return Response(status=status.HTTP_204_NO_CONTENT)
         serializer = AvatarSetSerializer(
             instance=request.user,
-            data=request.data
+            data=request.data,
+            context={'request': request}
         )
         serializer.is_valid(raise_exception=True)
         serializer.save()
@@ -89,10 +145,30 @@ class UserViewSet(UserViewSetDjoser):
         # Получаем список пользователей, на которых подписаны
         followed_users = self.request.user.followers.values_list(
             'author', flat=True)
-        # Подготовим список рецептов с сортировкой
+        # Подготовим список рецептов с сортировкой, не больше лимита
+        # на каждого автора: нумеруем рецепты внутри автора оконной функцией
+        # и отбираем первые номера на стороне базы
+        ordering = (*Recipe._meta.ordering, '-id')
+        ranked_recipes = Recipe.objects.filter(
+            author__in=followed_users
+        ).order_by().annotate(
+            row_number=Window(
+                RowNumber(),
+                partition_by=F('author_id'),
+                order_by=[
+                    F(field[1:]).desc() if field.startswith('-')
+                    else F(field).asc()
+                    for field in ordering
+                ]
+            )
+        ).values('id', 'row_number')
+        sql, params = ranked_recipes.query.sql_with_params()
         recipe_prefetch = Prefetch(
-            'recipes', queryset=Recipe.objects.order_by(
-                *Recipe._meta.ordering)
+            'recipes', queryset=Recipe.objects.filter(pk__in=RawSQL(
+                f'SELECT "id" FROM ({sql}) AS "ranked" '
+                'WHERE "row_number" <= %s',
+                (*params, get_recipes_limit(request))
+            )).order_by(*ordering)
         )
         # Соединяем рецепты с каждым пользователем, на которого подписаны
         queryset = User.objects.filter(
@@ -133,24 +209,91 @@ class UserViewSet(UserViewSetDjoser):
         )
 
 
-class TagsViewSet(ReadOnlyModelViewSet):
+class CatalogViewSet(ReadOnlyModelViewSet):
+    """
+    Базовый контроллер справочников, GET.
+    Условные запросы проверяются по версии таблицы справочника.
+    Справочник целиком отдается готовым снимком (см. api.snapshots)
+    с долгим публичным кэшированием.
+    """
+
+    permission_classes = (AllowAny,)
+    pagination_class = None
+
+    @property
+    def table(self):
+        return self.queryset.model._meta.model_name
+
+    def is_snapshot_request(self, request):
+        return self.action == 'list' and not request.query_params
+
+    def get_validators(self, request, *args, **kwargs):
+        versions, last_modified = get_table_state(request, self.table)
+        return make_etag(
+            self.table, versions[self.table], kwargs, normalize_query(request),
+            # Снимок отдается в двух кодировках с разными телами
+            self.is_snapshot_request(request) and accepts_gzip(request)
+        ), last_modified
+
+    def get_cache_control(self, request):
+        if self.is_snapshot_request(request):
+            return {
+                'public': True, 'max_age': settings.CATALOG_CACHE_MAX_AGE
+            }
+        return PRIVATE_CACHE_CONTROL
+
+    @conditional_get
+    def list(self, request, *args, **kwargs):
+        if not self.is_snapshot_request(request):
+            return super().list(request, *args, **kwargs)
+        versions, _ = get_table_state(request, self.table)
+        return snapshot_response(
+            request, get_snapshot(self, self.table, versions[self.table])
+        )
+
+    @conditional_get
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+
+class TagsViewSet(CatalogViewSet):
     """Контроллер Тэгов, GET."""
 
     queryset = Tag.objects.all()
-    permission_classes = (AllowAny,)
     serializer_class = TagSerializer
-    pagination_class = None
 
 
-class IngredientsViewSet(ReadOnlyModelViewSet):
+class IngredientsViewSet(CatalogViewSet):
     """Контроллер продуктов, GET."""
 
     queryset = Ingredient.objects.all()
-    permission_classes = (AllowAny,)
     serializer_class = IngredientSerializer
     filter_backends = (DjangoFilterBackend,)
     filterset_class = IngredientFilter
-    pagination_class = None
+    search_param = 'name'
+
+    def get_validators(self, request, *args, **kwargs):
+        if self.action != 'list' or not request.query_params.get(
+            self.search_param
+        ):
+            return super().get_validators(request, *args, **kwargs)
+        # Поиск отвечает индекс в памяти: валидаторы берем из него же
+        ingredient_index.ensure_fresh()
+        return make_etag(
+            ingredient_index.version, normalize_query(request)
+        ), ingredient_index.updated_at
+
+    def list(self, request, *args, **kwargs):
+        if request.query_params.get(self.search_param, '').strip():
+            return self.search(request)
+        return super().list(request, *args, **kwargs)
+
+    @conditional_get
+    def search(self, request):
+        """Поиск по названию обслуживается индексом без обращения к базе."""
+        return Response(ingredient_index.search(
+            request.query_params[self.search_param]
+        ))
 
 
 class RecipesViewSet(ModelViewSet):
@@ -161,6 +304,89 @@ class RecipesViewSet(ModelViewSet):
     filterset_class = RecipeFilter
     permission_classes = (IsAuthenticatedOrReadOnly, IsAuthorOrReadOnly,)
     http_method_names = ('get', 'post', 'patch', 'delete')
+    # Таблицы, от которых зависит число рецептов в выдаче с фильтрами
+    count_cache_tables = ('recipe', 'favorite', 'shoppingcart')
+
+    def _user_flag(self, model):
+        """Признак наличия рецепта в избранном или списке покупок."""
+        if self.request.user.is_anonymous:
+            return Value(False, output_field=BooleanField())
+        return Exists(
+            model.objects.filter(user=self.request.user, recipe=OuterRef('pk'))
+        )
+
+    def get_queryset(self):
+        """
+        Подтягивает авторов рецептов, а флаги избранного и списка покупок
+        вычисляет в том же запросе, что и сами рецепты. Теги и продукты
+        загружаются пакетно при сериализации (см. serialize_recipes).
+        Число запросов не зависит от размера страницы.
+        """
+        return super().get_queryset().select_related(
+            'author'
+        ).annotate(
+            is_favorited=self._user_flag(Favorite),
+            is_in_shopping_cart=self._user_flag(ShoppingCart),
+        )
+
+    def get_object(self):
+        # Рецепт нужен и для валидаторов, и для ответа: загрузим один раз
+        if not hasattr(self, '_recipe'):
+            self._recipe = super().get_object()
+        return self._recipe
+
+    def get_validators(self, request, *args, **kwargs):
+        """
+        Валидаторы условных запросов к рецептам. Время последнего
+        изменения учитывает и таблицы персональных признаков, чтобы
+        If-Modified-Since не скрывал смену избранного и подписок.
+        """
+        if self.action == 'retrieve':
+            recipe = self.get_object()
+            versions, last_modified = get_table_state(
+                request, *FRAGMENT_TABLES, *PERSONAL_TABLES
+            )
+            return make_etag(
+                recipe.pk,
+                recipe.updated_at,
+                recipe.author.updated_at,
+                recipe.is_favorited,
+                recipe.is_in_shopping_cart,
+                recipe.author_id in get_followed_authors(request),
+                *(versions[table] for table in FRAGMENT_TABLES)
+            ), max(filter(None, (
+                last_modified, recipe.updated_at, recipe.author.updated_at
+            )))
+        versions, last_modified = get_table_state(
+            request, 'recipe', 'user', *FRAGMENT_TABLES, *PERSONAL_TABLES
+        )
+        return make_etag(
+            versions, request.user.pk, normalize_query(request)
+        ), last_modified
+
+    @conditional_get
+    def list(self, request, *args, **kwargs):
+        """
+        Список рецептов. С параметром facets=tags рядом со страницей
+        отдаются счетчики рецептов по тегам для тех же фильтров.
+        """
+        facets = get_requested_facets(request)
+        recipes = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(recipes)
+        if page is None:
+            return Response(serialize_recipes(recipes, request))
+        response = self.get_paginated_response(
+            serialize_recipes(page, request)
+        )
+        if TAGS_FACET in facets:
+            response.data[FACETS_PARAM] = {
+                TAGS_FACET: get_tag_facets(self, recipes, request)
+            }
+        return response
+
+    @conditional_get
+    def retrieve(self, request, *args, **kwargs):
+        return Response(serialize_recipes([self.get_object()], request)[0])
 
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
@@ -177,11 +403,15 @@ class RecipesViewSet(ModelViewSet):
         permission_classes=(AllowAny,)
     )
     def get_short_link(self, request, pk=None):
-        if not Recipe.objects.filter(pk=pk).exists():
+        try:
+            recipe_id = int(pk)
+        except ValueError:
+            recipe_id = None
+        if recipe_id is None or recipe_id < 0 or not recipe_exists(recipe_id):
             raise ValidationError(RECIPE_NOT_FOUND.format(pk))
         return Response({
             'short-link': request.build_absolute_uri(
-                reverse('recipes:recipe_short_link', args=[pk])
+                reverse('recipes:recipe_short_code', args=[encode(recipe_id)])
             )
         })
 
@@ -230,32 +460,12 @@ class RecipesViewSet(ModelViewSet):
         detail=False,
         methods=['GET'],
         url_path=settings.DOWNLOAD_CART_POINT,
-        permission_classes=(IsAuthenticated,)
+        permission_classes=(IsAuthenticated,),
+        renderer_classes=SHOPPING_LIST_RENDERERS
     )
     def download_shopping_cart(self, request):
-        """Отдаёт файл со списком продуктов к покупке."""
-        recipes = [rec.recipe for rec in request.user.shoppingcarts.all()]
-        ingredients_with_amount = RecipeIngredient.objects.filter(
-            recipe__in=recipes
-        ).values(
-            'ingredient__name',
-            'ingredient__measurement_unit'
-        ).annotate(
-            total_amount=Sum('amount')
-        ).order_by(
-            'ingredient__name'
-        )
-
-        content = render_to_string(
-            'shop_template.txt', {
-                'current_date': datetime.now(),
-                'ingredients': ingredients_with_amount,
-                'recipes': recipes,
-            }
-        )
-
-        return FileResponse(
-            content,
-            as_attachment=True,
-            filename=f'shopping_list_{datetime.now().strftime("%d.%m.%Y")}.txt'
-        )
+        """
+        Отдаёт файл со списком продуктов к покупке в формате txt (по
+        умолчанию), csv или json (параметр format).
+        """
+        return stream_shopping_list(request.user, request.accepted_renderer)
@@ -138,6 +138,61 @@ REST_FRAMEWORK = {
 
 }
 
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv(
+            'CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'
+        ),
+        'LOCATION': os.getenv('CACHE_LOCATION', 'foodgram'),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv('CACHE_MAX_ENTRIES', 10_000)),
+        },
+    }
+}
+
+# Время жизни сериализованных фрагментов рецептов, сек.
+RECIPE_FRAGMENT_CACHE_TIMEOUT = int(
+    os.getenv('RECIPE_FRAGMENT_CACHE_TIMEOUT', 24 * 60 * 60)
+)
+# Как часто индекс поиска продуктов сверяет версию таблицы продуктов, сек.
+INGREDIENT_INDEX_CHECK_INTERVAL = int(
+    os.getenv('INGREDIENT_INDEX_CHECK_INTERVAL', 60)
+)
+# Срок публичного кэширования полных справочников тегов и продуктов, сек.
+CATALOG_CACHE_MAX_AGE = int(os.getenv('CATALOG_CACHE_MAX_AGE', 24 * 60 * 60))
+# Время жизни закэшированного числа записей постраничной выдачи, сек.
+PAGINATION_COUNT_CACHE_TIMEOUT = int(
+    os.getenv('PAGINATION_COUNT_CACHE_TIMEOUT', 60 * 60)
+)
+# Начиная с этого размера таблицы, выдача без фильтров на PostgreSQL
+# отдает оценку числа записей вместо точного подсчета
+PAGINATION_COUNT_ESTIMATE_THRESHOLD = int(
+    os.getenv('PAGINATION_COUNT_ESTIMATE_THRESHOLD', 100_000)
+)
+# Время жизни закэшированных счетчиков рецептов по тегам (facets=tags), сек.
+RECIPE_FACETS_CACHE_TIMEOUT = int(
+    os.getenv('RECIPE_FACETS_CACHE_TIMEOUT', 60 * 60)
+)
+# Файлы multipart/form-data больше этого размера (байт) Django пишет
+# во временный файл на диске, а не держит в памяти
+FILE_UPLOAD_MAX_MEMORY_SIZE = int(
+    os.getenv('FILE_UPLOAD_MAX_MEMORY_SIZE', 256 * 1024)
+)
+FILE_UPLOAD_TEMP_DIR = os.getenv('FILE_UPLOAD_TEMP_DIR')
+# Необработанные загрузки изображений ждут обработки здесь, вне MEDIA_ROOT
+IMAGE_UPLOAD_ROOT = os.getenv(
+    'IMAGE_UPLOAD_ROOT', os.path.join(BASE_DIR, 'uploads')
+)
+# Наибольшая сторона обработанного изображения, px
+IMAGE_MAX_SIZE = int(os.getenv('IMAGE_MAX_SIZE', 1600))
+# Наибольшая сторона вариантов изображения в WebP: миниатюры и карточки, px
+IMAGE_THUMBNAIL_SIZE = int(os.getenv('IMAGE_THUMBNAIL_SIZE', 150))
+IMAGE_CARD_SIZE = int(os.getenv('IMAGE_CARD_SIZE', 600))
+# Число попыток обработки изображения при сбоях чтения файла
+IMAGE_JOB_ATTEMPTS = int(os.getenv('IMAGE_JOB_ATTEMPTS', 3))
+# Через сколько секунд задание в обработке считается зависшим
+IMAGE_JOB_TIMEOUT = int(os.getenv('IMAGE_JOB_TIMEOUT', 5 * 60))
+
 AUTH_USER_MODEL = 'recipes.User'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
@@ -151,6 +206,13 @@ FAVORITES_POINT = 'favorite'
 SHOPPING_CART_POINT = 'shopping_cart'
 DOWNLOAD_CART_POINT = 'download_shopping_cart'
 SHORT_URL_PREFIX = 's/'
+SHORT_CODE_PREFIX = 'r/'
+# Сколько id рецептов помнит кэш коротких ссылок процесса и сколько
+# секунд; столько же редирект хранится в кэше nginx
+SHORT_LINK_CACHE_SIZE = int(os.getenv('SHORT_LINK_CACHE_SIZE', 10_000))
+SHORT_LINK_CACHE_TIMEOUT = int(os.getenv('SHORT_LINK_CACHE_TIMEOUT', 5 * 60))
+# Наибольшее число рецептов каждого автора в списке подписок
+MAX_RECIPES_LIMIT = 50
 
 SWAGGER_SETTINGS = {
     'SECURITY_DEFINITIONS': {
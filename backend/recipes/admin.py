@@ -1,15 +1,35 @@
 import ast
 
-import numpy
 from django.contrib import admin
+from django.contrib.admin.views.autocomplete import AutocompleteJsonView
+from django.contrib.admin.views.main import ChangeList
+from django.contrib.admin.widgets import AutocompleteSelect
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+from django.db.models import (
+    Count, Exists, Max, Min, OuterRef, Prefetch, Q, Subquery
+)
+from django.db.models.functions import Coalesce
+from django.http import JsonResponse
+from django.urls import path, reverse
+from django.utils.functional import SimpleLazyObject
 from django.utils.safestring import mark_safe
 
+from .images import get_image_urls
 from .models import (
-    Favorite, Follow, Ingredient, Recipe, RecipeIngredient, ShoppingCart, Tag,
-    User
+    Favorite, Follow, Ingredient, Recipe, RecipeIngredient, ShoppingCart,
+    TableVersion, Tag, User
 )
+from .shopping_lists import track_recipe_ingredients
+
+COOKING_TIME_BINS = 3
+HISTOGRAM_CACHE_KEY = 'cooking-time-histogram:{}'
+NOT_CACHED = object()
+INGREDIENT_LABEL = '{} ({})'
+INGREDIENT_LABELS_CACHE_KEY = 'ingredient-labels:{}'
+INGREDIENT_AUTOCOMPLETE_URL = 'recipes_ingredient_autocomplete'
 
 admin.site.empty_value_display = '-пусто-'
 
@@ -28,28 +48,67 @@ class MethodsForFilters(admin.SimpleListFilter):
     def lookups(self, request, model_admin):
         return self.options
 
+    def get_exists(self, model):
+        """Подзапрос EXISTS по связи class_field вместо соединения таблиц."""
+        relation = model._meta.get_field(self.class_field)
+        if relation.many_to_many:
+            related = relation.through
+            field_name = relation.field.m2m_reverse_field_name()
+        else:
+            related = relation.related_model
+            field_name = relation.field.name
+        return Exists(related.objects.filter(**{field_name: OuterRef('pk')}))
+
     def queryset(self, request, queryset):
-        class_field = self.class_field
         if self.value() == 'yes':
-            return queryset.filter(
-                **{f'{class_field}__isnull': False}
-            ).distinct()
+            return queryset.filter(self.get_exists(queryset.model))
         elif self.value() == 'no':
-            return queryset.filter(
-                **{f'{class_field}': None}
-            )
+            return queryset.filter(~self.get_exists(queryset.model))
         return queryset
 
 
+def count_recipes(model):
+    """
+    Подзапрос числа рецептов объекта по таблице связи. Выполняется только
+    для строк страницы списка, без группировки всей таблицы.
+    """
+    relation = model._meta.get_field('recipes')
+    field_name = relation.field.m2m_reverse_field_name()
+    return Coalesce(Subquery(
+        relation.through.objects.filter(
+            **{field_name: OuterRef('pk')}
+        ).order_by().values(field_name).annotate(
+            total=Count(relation.field.m2m_field_name(), distinct=True)
+        ).values('total')
+    ), 0)
+
+
+class RecipesCountChangeList(ChangeList):
+    """Список объектов с числом рецептов каждого (recipes_total)."""
+
+    def get_queryset(self, request):
+        self.root_queryset = self.root_queryset.annotate(
+            recipes_total=count_recipes(self.model)
+        )
+        return super().get_queryset(request)
+
+
 class RecipesCountMixin:
-    """Показывает кол-во рецептов для того или иного связанного объекта."""
+    """
+    Показывает кол-во рецептов для того или иного связанного объекта.
+    Число считается только в списке объектов (RecipesCountChangeList),
+    поэтому миксин должен стоять в базовых классах раньше ModelAdmin.
+    """
 
     list_display = ['recipes_count']
 
-    @admin.display(description='Рецептов')
+    def get_changelist(self, request, **kwargs):
+        return RecipesCountChangeList
+
+    @admin.display(description='Рецептов', ordering='recipes_total')
     def recipes_count(self, obj):
-        """Считает рецепты для связанного объекта"""
-        return obj.recipes.count()
+        """Читает число рецептов из аннотации запроса."""
+        return obj.recipes_total
 
 
 class GetImageMixin:
@@ -60,13 +119,16 @@ class GetImageMixin:
     def image_miniature(self, obj):
         """Выводит изображение в миниатюре для Пользователей и Рецептов."""
         if hasattr(obj, 'image'):
-            image_obj = obj.image
+            urls = get_image_urls(obj, 'image')
             obj_name = obj.name
         else:
-            image_obj = obj.avatar
+            urls = get_image_urls(obj, 'avatar')
             obj_name = obj.username
-        if image_obj:
-            return f'<img src="{image_obj.url}" alt="{obj_name}" width="50">'
+        if urls:
+            # Миниатюра заранее уменьшена (см. recipes/images.py)
+            return (
+                f'<img src="{urls["thumbnail"]}" alt="{obj_name}" width="50">'
+            )
         return 'not image'
 
 
@@ -106,6 +168,123 @@ class HasFollowersFilter(MethodsForFilters):
     class_field = 'followers'
 
 
+def get_cooking_time_histogram():
+    """
+    Гистограмма времени приготовления, как numpy.histogram(bins=3):
+    (границы интервалов, число рецептов в каждом). Считается в базе
+    двумя запросами и хранится в кэше до изменения рецептов. Если
+    рецептов меньше трех, возвращает None.
+    """
+    table = Recipe._meta.model_name
+    key = HISTOGRAM_CACHE_KEY.format(TableVersion.get_versions(table)[table])
+    histogram = cache.get(key, NOT_CACHED)
+    if histogram is not NOT_CACHED:
+        return histogram
+    stats = Recipe.objects.aggregate(
+        total=Count('id'), low=Min('cooking_time'), high=Max('cooking_time')
+    )
+    if stats['total'] < COOKING_TIME_BINS:
+        histogram = None
+    else:
+        low, high = stats['low'], stats['high']
+        if low == high:
+            # Как numpy: одинаковые значения попадают в интервал шириной 1
+            low, high = low - 0.5, high + 0.5
+        step = (high - low) / COOKING_TIME_BINS
+        edges = [low + step * i for i in range(COOKING_TIME_BINS)] + [high]
+        # Интервалы полуоткрытые, последний включает верхнюю границу
+        bins = [
+            Q(cooking_time__gte=edges[i], cooking_time__lt=edges[i + 1])
+            for i in range(COOKING_TIME_BINS - 1)
+        ] + [Q(cooking_time__gte=edges[-2])]
+        counts = Recipe.objects.aggregate(**{
+            f'bin_{i}': Count('id', filter=condition)
+            for i, condition in enumerate(bins)
+        })
+        histogram = (
+            [counts[f'bin_{i}'] for i in range(COOKING_TIME_BINS)], edges
+        )
+    cache.set(key, histogram, None)
+    return histogram
+
+
+def get_ingredient_labels():
+    """
+    Подписи продуктов с ед. измерения {id: подпись}. Хранятся в кэше до
+    изменения продуктов.
+    """
+    table = Ingredient._meta.model_name
+    key = INGREDIENT_LABELS_CACHE_KEY.format(
+        TableVersion.get_versions(table)[table]
+    )
+    labels = cache.get(key)
+    if labels is None:
+        labels = {
+            pk: INGREDIENT_LABEL.format(name, unit)
+            for pk, name, unit in Ingredient.objects.values_list(
+                'pk', 'name', 'measurement_unit'
+            )
+        }
+        cache.set(key, labels, None)
+    return labels
+
+
+class IngredientAutocompleteSelect(AutocompleteSelect):
+    """
+    Выбор продукта с поиском. Подписи выбранных продуктов берутся из
+    get_ingredient_labels, а не запросом на каждую строку формы; поиск
+    идет через IngredientAutocompleteView.
+    """
+
+    def __init__(self, *args, labels, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.labels = labels
+
+    def get_url(self):
+        return reverse(
+            f'{self.admin_site.name}:{INGREDIENT_AUTOCOMPLETE_URL}'
+        )
+
+    def optgroups(self, name, value, attr=None):
+        options = []
+        if not self.is_required:
+            options.append(self.create_option(name, '', '', False, 0))
+        for pk in value:
+            try:
+                label = self.labels.get(int(pk))
+            except (TypeError, ValueError):
+                continue
+            if label is not None:
+                options.append(self.create_option(
+                    name, pk, label, True, len(options)
+                ))
+        return [(None, options, 0)]
+
+
+class IngredientAutocompleteView(AutocompleteJsonView):
+    """Результаты поиска продуктов для выбора с ед. измерения."""
+
+    def get(self, request, *args, **kwargs):
+        self.term, self.model_admin, self.source_field, to_field_name = (
+            self.process_request(request)
+        )
+        if not self.has_perm(request):
+            raise PermissionDenied
+        self.object_list = self.get_queryset()
+        context = self.get_context_data()
+        return JsonResponse({
+            'results': [
+                {
+                    'id': str(getattr(ingredient, to_field_name)),
+                    'text': INGREDIENT_LABEL.format(
+                        ingredient.name, ingredient.measurement_unit
+                    ),
+                } for ingredient in context['object_list']
+            ],
+            'pagination': {'more': context['page_obj'].has_next()},
+        })
+
+
 class CookingTimeFilter(admin.SimpleListFilter):
     """
     Делит время приготовления на 3 категории, считает кол-во
@@ -121,13 +300,10 @@ class CookingTimeFilter(admin.SimpleListFilter):
         )
 
     def lookups(self, request, model_admin):
-        cooking_times = sorted(
-            Recipe.objects.values_list('cooking_time', flat=True)
-        )
-        if len(cooking_times) < 3:
+        histogram = get_cooking_time_histogram()
+        if histogram is None:
             return []
-        number_recipes, time_levels = numpy.histogram(
-            cooking_times, bins=3)
+        number_recipes, time_levels = histogram
         time_levels = list(map(int, time_levels))
 
         # Первый параметр в возврате есть строковое
@@ -164,11 +340,11 @@ class CookingTimeFilter(admin.SimpleListFilter):
 
 
 @admin.register(User)
-class UserAdmin(BaseUserAdmin, RecipesCountMixin, GetImageMixin):
+class UserAdmin(BaseUserAdmin, GetImageMixin):
     search_fields = ('email', 'username')
     list_display = [
         'id', 'username', 'full_name', 'email', 'image_miniature',
-        'subscription_count', 'follower_count', *RecipesCountMixin.list_display
+        'subscription_count', 'follower_count', 'recipes_count'
     ]
     list_filter = (
         'is_active', 'is_staff', 'is_superuser',
@@ -183,13 +359,18 @@ class UserAdmin(BaseUserAdmin, RecipesCountMixin, GetImageMixin):
     def full_name(self, user):
         return f'{user.first_name} {user.last_name}'.strip()
 
-    @admin.display(description='Подписчиков')
+    @admin.display(description='Подписчиков', ordering='subscribers_count')
     def subscription_count(self, user):
-        return user.authors.count()
+        return user.subscribers_count
 
-    @admin.display(description='Подписан на')
+    @admin.display(description='Подписан на', ordering='subscriptions_count')
     def follower_count(self, user):
-        return user.followers.count()
+        return user.subscriptions_count
+
+    @admin.display(description='Рецептов', ordering='recipes_count')
+    def recipes_count(self, user):
+        """Читает денормализованный счетчик вместо подсчета рецептов."""
+        return user.recipes_count
 
 
 @admin.register(Follow)
@@ -201,24 +382,53 @@ class FollowAdmin(admin.ModelAdmin):
 
 
 @admin.register(Tag)
-class TagAdmin(admin.ModelAdmin, RecipesCountMixin):
+class TagAdmin(RecipesCountMixin, admin.ModelAdmin):
     list_display = ['name', 'slug', *RecipesCountMixin.list_display]
     search_fields = ('name', 'slug')
 
 
 @admin.register(Ingredient)
-class IngredientAdmin(admin.ModelAdmin, RecipesCountMixin):
+class IngredientAdmin(RecipesCountMixin, admin.ModelAdmin):
     list_display = [
         'id', 'name', 'measurement_unit', *RecipesCountMixin.list_display]
     search_fields = ('name', 'measurement_unit')
     list_filter = (HasRecipesFilter,)
 
+    def get_urls(self):
+        return [
+            path(
+                'autocomplete/',
+                self.admin_site.admin_view(IngredientAutocompleteView.as_view(
+                    admin_site=self.admin_site
+                )),
+                name=INGREDIENT_AUTOCOMPLETE_URL
+            ),
+            *super().get_urls()
+        ]
+
 
 @admin.register(RecipeIngredient)
 class RecipeIngredientAdmin(admin.ModelAdmin):
     list_display = ('recipe', 'ingredient', 'amount')
     list_filter = ('recipe',)
 
+    def save_model(self, request, obj, form, change):
+        # Продукт могли перенести в другой рецепт: учтем оба
+        with track_recipe_ingredients(
+            obj.recipe_id, form.initial.get('recipe')
+        ):
+            super().save_model(request, obj, form, change)
+
+    def delete_model(self, request, obj):
+        with track_recipe_ingredients(obj.recipe_id):
+            super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        with track_recipe_ingredients(
+            *queryset.values_list('recipe_id', flat=True).distinct()
+        ):
+            super().delete_queryset(request, queryset)
+
 
 class RecipeIngredientInline(admin.TabularInline):
     """Выводит продукты в рецепте с мерой и ед. измерения."""
@@ -226,17 +436,24 @@ class RecipeIngredientInline(admin.TabularInline):
     model = RecipeIngredient
     extra = 0
     fields = ('recipe', 'ingredient', 'amount',)
+    autocomplete_fields = ('ingredient',)
+
+    def get_queryset(self, request):
+        # Заголовок строки (RecipeIngredient.__str__) выводит рецепт и продукт
+        return super().get_queryset(request).select_related(
+            'recipe', 'ingredient'
+        )
 
     def formfield_for_foreignkey(self, db_field, request, **kwargs):
-        """Переоформляет поле ingredient для вывода с ед.изм."""
-        field = super().formfield_for_foreignkey(db_field, request, **kwargs)
+        """Выбор продукта с поиском и подписью с ед.изм."""
         if db_field.name == 'ingredient':
-            new_choices = [
-                (item.pk, f'{item.name} ({item.measurement_unit})')
-                for item in Ingredient.objects.all()
-            ]
-            field.choices = new_choices
-        return field
+            kwargs['widget'] = IngredientAutocompleteSelect(
+                db_field, self.admin_site, using=kwargs.get('using'),
+                # Подписи загружаются один раз на страницу и только
+                # если в форме есть выбранные продукты
+                labels=SimpleLazyObject(get_ingredient_labels)
+            )
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
 
 
 @admin.register(Recipe)
@@ -261,16 +478,33 @@ class RecipeAdmin(admin.ModelAdmin, GetImageMixin):
     PRODUCT_TEMPLATE = '- {}, {} {}\n'
     RETURN = '<div style="white-space: nowrap;">{}</div>'
 
+    def get_queryset(self, request):
+        # Теги, продукты и авторы строк списка загружаются пачкой, а число
+        # добавлений в избранное хранится в самом рецепте (favorites_count)
+        return super().get_queryset(request).select_related(
+            'author'
+        ).prefetch_related(
+            'tags',
+            Prefetch(
+                'recipeingredients',
+                queryset=RecipeIngredient.objects.select_related('ingredient')
+            )
+        )
+
+    def save_related(self, request, form, formsets, change):
+        with track_recipe_ingredients(form.instance.pk):
+            super().save_related(request, form, formsets, change)
+
     @admin.display(description='Теги')
     @mark_safe
     def tags_list(self, recipe):
         """Выводит теги рецепта."""
         return '<br>'.join(tag.name for tag in recipe.tags.all())
 
-    @admin.display(description='В Избранном')
+    @admin.display(description='В Избранном', ordering='favorites_count')
     def favorite_count(self, recipe):
         """Показывает сколько рецептов в избранном."""
-        return recipe.favorites.count()
+        return recipe.favorites_count
 
     @admin.display(description='Продукты')
     @mark_safe
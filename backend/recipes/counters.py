@@ -0,0 +1,49 @@
+"""
+Денормализованные счетчики.
+
+Каждый счетчик описан как (модель со счетчиком, поле счетчика,
+модель считаемых записей, поле связи считаемой записи с моделью счетчика).
+Счетчики меняются атомарно (F-выражениями) сигналами при создании и
+удалении считаемых записей и пересчитываются командой rebuild_denormalized.
+"""
+from django.apps import apps as global_apps
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+
+COUNTERS = (
+    ('recipes.User', 'recipes_count', 'recipes.Recipe', 'author'),
+    ('recipes.User', 'subscribers_count', 'recipes.Follow', 'author'),
+    ('recipes.User', 'subscriptions_count', 'recipes.Follow', 'from_user'),
+    ('recipes.Recipe', 'favorites_count', 'recipes.Favorite', 'recipe'),
+)
+
+
+def change_counters(instance, delta):
+    """Изменяет на delta счетчики, в которых учитывается запись."""
+    source_label = instance._meta.label
+    for counter_label, field, label, relation in COUNTERS:
+        if label != source_label:
+            continue
+        global_apps.get_model(counter_label).objects.filter(
+            pk=getattr(instance, f'{relation}_id')
+        ).update(**{field: Greatest(F(field) + delta, 0)})
+
+
+def rebuild_counters():
+    """
+    Пересчитывает счетчики и исправляет расхождения.
+    Возвращает число исправленных записей по каждому счетчику.
+    """
+    fixed = {}
+    for counter_label, field, label, relation in COUNTERS:
+        actual = Coalesce(Subquery(
+            global_apps.get_model(label).objects.filter(
+                **{relation: OuterRef('pk')}
+            ).order_by().values(relation).annotate(
+                count=Count('pk')
+            ).values('count')
+        ), 0)
+        fixed[f'{counter_label}.{field}'] = global_apps.get_model(
+            counter_label
+        ).objects.exclude(**{field: actual}).update(**{field: actual})
+    return fixed
@@ -0,0 +1,306 @@
+"""
+Обработка загруженных изображений вне запроса.
+
+Запрос только сохраняет присланный файл в хранилище необработанных
+загрузок (вне MEDIA_ROOT, наружу не отдается) и ставит задание ImageJob
+(enqueue_image). Команда process_images выбирает задания из таблицы,
+проверяет изображение, поворачивает по EXIF, уменьшает до
+settings.IMAGE_MAX_SIZE, перекодирует без метаданных и записывает
+результат в поле модели (process_job). Пока задание не выполнено,
+поле состояния <поле>_status объекта (image_status рецепта,
+avatar_status пользователя) равно ImageStatus.PENDING. Аватар до конца
+обработки отдается таким, каким его загрузили (keep_upload в enqueue_image).
+
+Вместе с изображением сохраняются его уменьшенные копии в WebP
+(варианты VARIANTS) рядом с файлом поля: recipes/variants/<имя>.<вариант>.webp.
+Флаг <поле>_variants модели отмечает, что варианты созданы; для
+изображений, загруженных раньше, их создает команда make_image_variants.
+"""
+from datetime import timedelta
+from io import BytesIO
+from pathlib import Path
+
+from django.apps import apps as global_apps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.db import models, transaction
+from django.utils import timezone
+from django.utils.functional import cached_property
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# Ошибки содержимого файла: повторять обработку бессмысленно
+INVALID_IMAGE_ERRORS = (
+    UnidentifiedImageError, Image.DecompressionBombError, SyntaxError,
+    ValueError,
+)
+JPEG_QUALITY = 85
+WEBP_QUALITY = 80
+# Варианты изображения и настройки их наибольшей стороны
+VARIANTS = {
+    'thumbnail': 'IMAGE_THUMBNAIL_SIZE',
+    'card': 'IMAGE_CARD_SIZE',
+    'full': 'IMAGE_MAX_SIZE',
+}
+VARIANTS_DIRECTORY = 'variants'
+VARIANT_NAME = '{}.{}.webp'
+# Флаг созданных вариантов изображения у модели
+VARIANTS_FIELD = '{}_variants'
+# Поле состояния обработки изображения у модели
+STATUS_FIELD = '{}_status'
+
+
+class ImageStatus(models.TextChoices):
+    PENDING = 'pending', 'Обрабатывается'
+    READY = 'ready', 'Готово'
+    FAILED = 'failed', 'Ошибка обработки'
+
+
+class UploadStorage(FileSystemStorage):
+    """Хранилище необработанных загрузок в settings.IMAGE_UPLOAD_ROOT."""
+
+    @cached_property
+    def base_location(self):
+        return settings.IMAGE_UPLOAD_ROOT
+
+    def _clear_cached_properties(self, setting, **kwargs):
+        super()._clear_cached_properties(setting, **kwargs)
+        if setting == 'IMAGE_UPLOAD_ROOT':
+            self.__dict__.pop('base_location', None)
+            self.__dict__.pop('location', None)
+
+
+upload_storage = UploadStorage()
+
+
+def set_image_status(instance, field_name, status, *fields):
+    """Сохраняет состояние обработки изображения поля и поля fields."""
+    status_field = STATUS_FIELD.format(field_name)
+    setattr(instance, status_field, status)
+    instance.save(update_fields={status_field, *fields, 'updated_at'})
+
+
+def discard_job(job):
+    job.source.delete(save=False)
+    job.delete()
+
+
+def discard_pending_jobs(instance, field_name):
+    """Отменяет ожидающие задания поля объекта."""
+    ImageJob = global_apps.get_model('recipes.ImageJob')
+    for job in ImageJob.objects.filter(
+        ImageJob.target_filter(instance, field_name),
+        status=ImageJob.Status.PENDING
+    ):
+        discard_job(job)
+
+
+def enqueue_image(instance, field_name, upload, keep_upload=False):
+    """
+    Сохраняет загрузку и ставит задание на обработку. Ожидающие задания
+    того же поля отменяются: обработать нужно только последнюю загрузку.
+    С keep_upload до конца обработки поле отдает загрузку как есть.
+    """
+    ImageJob = global_apps.get_model('recipes.ImageJob')
+    discard_pending_jobs(instance, field_name)
+    fields = ()
+    if keep_upload:
+        # Временный файл загрузки хранилище перемещает: задание
+        # получит копию из поля
+        field = getattr(instance, field_name)
+        field.save(Path(upload.name).name, upload, save=False)
+        upload = field
+        # Варианты прежнего изображения к загрузке не относятся
+        variants_field = VARIANTS_FIELD.format(field_name)
+        setattr(instance, variants_field, False)
+        fields = (field_name, variants_field)
+    job = ImageJob(target=instance, field_name=field_name)
+    with upload:
+        job.source.save(Path(upload.name).name, upload, save=False)
+    job.save()
+    set_image_status(instance, field_name, ImageStatus.PENDING, *fields)
+    return job
+
+
+def get_variant_name(name, variant):
+    """Имя файла варианта изображения с именем name в хранилище."""
+    path = Path(name)
+    return str(
+        path.parent / VARIANTS_DIRECTORY / VARIANT_NAME.format(
+            path.stem, variant
+        )
+    )
+
+
+def has_variants(instance, field_name):
+    return getattr(instance, VARIANTS_FIELD.format(field_name), False)
+
+
+def get_image_urls(instance, field_name):
+    """
+    Адреса вариантов изображения {вариант: адрес}. Пока варианты не
+    созданы, все они указывают на само изображение; без изображения None.
+    """
+    image = getattr(instance, field_name)
+    if not image:
+        return None
+    if not has_variants(instance, field_name):
+        return dict.fromkeys(VARIANTS, image.url)
+    return {
+        variant: image.storage.url(get_variant_name(image.name, variant))
+        for variant in VARIANTS
+    }
+
+
+def open_image(source):
+    """Проверяет изображение и открывает его повернутым по EXIF."""
+    with Image.open(source) as image:
+        image.verify()
+    source.seek(0)
+    with Image.open(source) as image:
+        return ImageOps.exif_transpose(image)
+
+
+def resize(image, setting):
+    size = getattr(settings, setting)
+    image = image.copy()
+    image.thumbnail((size, size))
+    return image
+
+
+def encode_image(image):
+    """
+    Возвращает (байты, расширение) перекодированной копии изображения
+    без метаданных, не больше IMAGE_MAX_SIZE.
+    """
+    image = resize(image, 'IMAGE_MAX_SIZE')
+    output = BytesIO()
+    # Новый файл собирается только из пикселей: EXIF, ICC и прочие
+    # метаданные исходника в него не попадают
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image.convert('RGBA').save(output, 'PNG', optimize=True)
+        return output.getvalue(), 'png'
+    image.convert('RGB').save(
+        output, 'JPEG', quality=JPEG_QUALITY, optimize=True
+    )
+    return output.getvalue(), 'jpg'
+
+
+def encode_variants(image):
+    """Варианты изображения в WebP: {вариант: байты}."""
+    mode = 'RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB'
+    variants = {}
+    for variant, setting in VARIANTS.items():
+        output = BytesIO()
+        resize(image, setting).convert(mode).save(
+            output, 'WEBP', quality=WEBP_QUALITY, method=6
+        )
+        variants[variant] = output.getvalue()
+    return variants
+
+
+def save_variants(instance, field_name, variants):
+    """Записывает варианты изображения поля и отмечает их флагом."""
+    image = getattr(instance, field_name)
+    for variant, content in variants.items():
+        name = get_variant_name(image.name, variant)
+        # Имя варианта производно от имени изображения: старый файл
+        # перезаписывается
+        image.storage.delete(name)
+        image.storage.save(name, ContentFile(content))
+    setattr(instance, VARIANTS_FIELD.format(field_name), True)
+    return VARIANTS_FIELD.format(field_name)
+
+
+def make_variants(instance, field_name):
+    """
+    Создает варианты уже обработанного изображения (для изображений,
+    загруженных до появления вариантов).
+    """
+    with getattr(instance, field_name).open('rb') as source:
+        variants = encode_variants(open_image(source))
+    instance.save(update_fields=(
+        save_variants(instance, field_name, variants), 'updated_at'
+    ))
+
+
+def claim_job():
+    """
+    Берет в работу самое старое ожидающее задание или задание, зависшее
+    в обработке дольше settings.IMAGE_JOB_TIMEOUT (процесс обработки
+    завершился аварийно).
+    """
+    ImageJob = global_apps.get_model('recipes.ImageJob')
+    stale = timezone.now() - timedelta(seconds=settings.IMAGE_JOB_TIMEOUT)
+    with transaction.atomic():
+        job = ImageJob.objects.select_for_update(skip_locked=True).filter(
+            models.Q(status=ImageJob.Status.PENDING) | models.Q(
+                status=ImageJob.Status.PROCESSING, updated_at__lt=stale
+            )
+        ).order_by('created_at').first()
+        if job is None:
+            return None
+        job.status = ImageJob.Status.PROCESSING
+        job.attempts += 1
+        job.save(update_fields=('status', 'attempts', 'updated_at'))
+    return job
+
+
+def fail_job(job, error, permanent):
+    """
+    Сохраняет ошибку. Задание повторяется, пока ошибка не окончательная
+    и не исчерпаны попытки; иначе изображение помечается ошибочным.
+    """
+    job.error = f'{type(error).__name__}: {error}'
+    permanent = permanent or job.attempts >= settings.IMAGE_JOB_ATTEMPTS
+    job.status = job.Status.FAILED if permanent else job.Status.PENDING
+    job.save(update_fields=('status', 'error', 'updated_at'))
+    if permanent and job.target is not None and not job.is_superseded():
+        set_image_status(job.target, job.field_name, ImageStatus.FAILED)
+
+
+def process_job(job):
+    """
+    Обрабатывает задание. Результат записывается, только если после
+    этой загрузки в то же поле не загружали новую; успешное задание
+    удаляется вместе с исходным файлом.
+    """
+    if job.attempts > settings.IMAGE_JOB_ATTEMPTS:
+        # Обработка этого файла уже не раз обрывала процесс
+        fail_job(job, TimeoutError('обработка не завершилась'), True)
+        return False
+    try:
+        with job.source.open('rb') as source:
+            image = open_image(source)
+        content, extension = encode_image(image)
+        variants = encode_variants(image)
+    except INVALID_IMAGE_ERRORS as error:
+        fail_job(job, error, permanent=True)
+        return False
+    except OSError as error:
+        fail_job(job, error, permanent=False)
+        return False
+    target = job.target
+    if target is not None and not job.is_superseded():
+        getattr(target, job.field_name).save(
+            f'{Path(job.source.name).stem}.{extension}',
+            ContentFile(content),
+            save=False
+        )
+        set_image_status(
+            target, job.field_name, ImageStatus.READY, job.field_name,
+            save_variants(target, job.field_name, variants)
+        )
+    discard_job(job)
+    return True
+
+
+def process_pending_jobs():
+    """Обрабатывает все готовые к запуску задания. Возвращает их число."""
+    processed = 0
+    while True:
+        job = claim_job()
+        if job is None:
+            return processed
+        process_job(job)
+        processed += 1
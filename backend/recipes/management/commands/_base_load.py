@@ -1,5 +1,7 @@
 import json
 
+from recipes.models import TableVersion
+
 
 class LoadDataBase:
 
@@ -13,6 +15,10 @@ class LoadDataBase:
             help='Путь к файлу JSON'
         )
 
+    def prepare_objects(self, objects):
+        """Дополняет объекты перед загрузкой (bulk_create не вызывает save)."""
+        return objects
+
     def handle(self, *args, **options):
         """Загружает данные из JSON-файла."""
 
@@ -21,9 +27,13 @@ class LoadDataBase:
         try:
             with open(path_to_file, mode='r', encoding='utf-8') as file:
                 items = self.model_class.objects.bulk_create(
-                    (self.model_class(**item) for item in json.load(file)),
+                    self.prepare_objects(
+                        self.model_class(**item) for item in json.load(file)
+                    ),
                     ignore_conflicts=True
                 )
+                # bulk_create не отправляет сигналы, версию меняем сами
+                TableVersion.bump(self.model_class._meta.model_name)
                 self.stdout.write(
                     self.style.SUCCESS(f'Загружено объектов: {len(items)}')
                 )
@@ -0,0 +1,171 @@
+import re
+from random import Random
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef, Sum
+
+from recipes.models import (
+    Favorite, Ingredient, Recipe, RecipeIngredient, ShoppingCart,
+    ShoppingListItem, Tag, User
+)
+from recipes.shopping_lists import rebuild_shopping_lists
+
+SEED_PREFIX = 'plan-check'
+INGREDIENTS_PER_RECIPE = 5
+RECIPES_PER_CART = 10
+BATCH_SIZE = 2000
+# Полный просмотр таблицы в плане PostgreSQL и SQLite
+SEQUENTIAL_SCAN = {
+    'postgresql': re.compile(r'Seq Scan on (\w+)'),
+    'sqlite': re.compile(r'\bSCAN (?:TABLE )?(\w+)\b(?! USING)'),
+}
+# SQLite называет таблицы подзапросов их псевдонимами Django (U0, U1...)
+SUBQUERY_ALIAS = re.compile(r'U\d+')
+PLAN_REGRESSION = 'Полный просмотр таблиц в запросах:\n{}'
+
+
+class Command(BaseCommand):
+    """
+    Заполняет базу большим набором данных, выполняет EXPLAIN для частых
+    запросов и завершается ошибкой, если хотя бы один из них читает
+    таблицы полным просмотром вместо индексов. Все изменения базы
+    откатываются.
+    """
+
+    help = 'Проверяет планы частых запросов на объемных данных'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipes', type=int, default=20_000)
+        parser.add_argument('--users', type=int, default=500)
+        parser.add_argument('--ingredients', type=int, default=2_000)
+
+    def handle(self, *args, **options):
+        vendor = connection.vendor
+        if vendor not in SEQUENTIAL_SCAN:
+            raise CommandError(f'Планы {vendor} не поддерживаются')
+        with transaction.atomic():
+            user = self.seed(**options)
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+            regressions = []
+            for name, queryset, tables in self.get_hot_queries(user):
+                plan = queryset.explain()
+                self.stdout.write(f'-- {name}\n{plan}\n')
+                watched = {model._meta.db_table for model in tables}
+                scanned = {
+                    table for table in SEQUENTIAL_SCAN[vendor].findall(plan)
+                    if table in watched or SUBQUERY_ALIAS.fullmatch(table)
+                }
+                if scanned:
+                    regressions.append(f'{name}: {", ".join(sorted(scanned))}')
+            transaction.set_rollback(True)
+        if regressions:
+            raise CommandError(PLAN_REGRESSION.format('\n'.join(regressions)))
+        self.stdout.write(
+            self.style.SUCCESS('Планы запросов используют индексы')
+        )
+
+    def seed(self, recipes, users, ingredients, **options):
+        """Создает данные и возвращает пользователя с корзиной и избранным."""
+        random = Random(0)
+        User.objects.bulk_create(
+            (
+                User(
+                    username=f'{SEED_PREFIX}-{i}',
+                    email=f'{SEED_PREFIX}-{i}@example.com'
+                ) for i in range(users)
+            ), batch_size=BATCH_SIZE
+        )
+        authors = list(User.objects.filter(username__startswith=SEED_PREFIX))
+        Ingredient.objects.bulk_create(
+            (
+                Ingredient(name=f'{SEED_PREFIX} {i}', measurement_unit='г')
+                for i in range(ingredients)
+            ), batch_size=BATCH_SIZE
+        )
+        ingredient_ids = list(Ingredient.objects.filter(
+            name__startswith=SEED_PREFIX
+        ).values_list('pk', flat=True))
+        tags = list(Tag.objects.all()) or [Tag.objects.create(
+            name=SEED_PREFIX, slug=SEED_PREFIX
+        )]
+        Recipe.objects.bulk_create(
+            (
+                Recipe(
+                    name=f'{SEED_PREFIX} {i}',
+                    author=random.choice(authors),
+                    text=SEED_PREFIX,
+                    cooking_time=random.randint(1, 180),
+                    image='recipes/plan-check.png',
+                    tags_mask=random.choice(tags).mask,
+                ) for i in range(recipes)
+            ), batch_size=BATCH_SIZE
+        )
+        recipe_ids = list(Recipe.objects.filter(
+            text=SEED_PREFIX
+        ).values_list('pk', flat=True))
+        RecipeIngredient.objects.bulk_create(
+            (
+                RecipeIngredient(
+                    recipe_id=recipe_id, ingredient_id=ingredient_id,
+                    amount=random.randint(1, 500)
+                )
+                for recipe_id in recipe_ids
+                for ingredient_id in random.sample(
+                    ingredient_ids,
+                    min(INGREDIENTS_PER_RECIPE, len(ingredient_ids))
+                )
+            ), batch_size=BATCH_SIZE
+        )
+        for model in (Favorite, ShoppingCart):
+            model.objects.bulk_create(
+                (
+                    model(user=author, recipe_id=recipe_id)
+                    for author in authors
+                    for recipe_id in random.sample(
+                        recipe_ids, min(RECIPES_PER_CART, len(recipe_ids))
+                    )
+                ), batch_size=BATCH_SIZE
+            )
+        rebuild_shopping_lists()
+        return authors[0]
+
+    @staticmethod
+    def get_hot_queries(user):
+        """
+        Частые запросы API: (название, выборка, таблицы, которые
+        запрос должен читать по индексу).
+        """
+        recipes = Recipe.objects.order_by('-pub_date', '-id')
+        return (
+            ('Лента рецептов', recipes[:6], (Recipe,)),
+            (
+                'Рецепты автора',
+                recipes.filter(author=user)[:6],
+                (Recipe,)
+            ),
+            *(
+                (
+                    f'Признак {model._meta.verbose_name}',
+                    recipes.annotate(flag=Exists(model.objects.filter(
+                        user=user, recipe=OuterRef('pk')
+                    ))).filter(flag=True)[:6],
+                    (model,)
+                ) for model in (Favorite, ShoppingCart)
+            ),
+            (
+                'Сводный список покупок',
+                ShoppingListItem.objects.filter(user=user).values(
+                    'ingredient__name', 'amount'
+                ).order_by('ingredient__name'),
+                (ShoppingListItem,)
+            ),
+            (
+                'Пересчет списка покупок',
+                RecipeIngredient.objects.filter(
+                    recipe__shoppingcarts__user=user
+                ).values('ingredient').annotate(total_amount=Sum('amount')),
+                (RecipeIngredient, ShoppingCart)
+            ),
+        )
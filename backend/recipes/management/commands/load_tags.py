@@ -12,3 +12,6 @@ class Command(LoadDataBase, BaseCommand):
     """
 
     model_class = Tag
+
+    def prepare_objects(self, objects):
+        return Tag.assign_bits(list(objects))
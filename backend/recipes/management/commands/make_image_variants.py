@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+
+from recipes.images import (
+    INVALID_IMAGE_ERRORS, STATUS_FIELD, VARIANTS_FIELD, ImageStatus,
+    make_variants
+)
+from recipes.models import Recipe, User
+
+# Модели и поля изображений, для которых создаются варианты
+IMAGE_FIELDS = ((Recipe, 'image'), (User, 'avatar'))
+BATCH_SIZE = 100
+
+
+class Command(BaseCommand):
+    """
+    Создает варианты изображений (см. recipes/images.py), загруженных
+    до их появления. Новые загрузки получают варианты при обработке.
+    """
+
+    help = 'Создает уменьшенные копии изображений рецептов и аватаров'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Пересоздать варианты и у изображений, где они уже есть'
+        )
+
+    def handle(self, *args, **options):
+        for model, field_name in IMAGE_FIELDS:
+            objects = model.objects.exclude(**{field_name: ''}).exclude(
+                **{f'{field_name}__isnull': True}
+            )
+            if not options['all']:
+                objects = objects.filter(
+                    **{VARIANTS_FIELD.format(field_name): False}
+                )
+            objects = objects.filter(
+                **{STATUS_FIELD.format(field_name): ImageStatus.READY}
+            )
+            created = failed = 0
+            for instance in objects.order_by('pk').iterator(BATCH_SIZE):
+                try:
+                    make_variants(instance, field_name)
+                except (*INVALID_IMAGE_ERRORS, OSError) as error:
+                    failed += 1
+                    self.stderr.write(
+                        f'{model._meta.verbose_name} {instance.pk}: {error}'
+                    )
+                    continue
+                created += 1
+            self.stdout.write(
+                f'{model._meta.verbose_name_plural}: создано {created}, '
+                f'ошибок {failed}'
+            )
@@ -0,0 +1,39 @@
+from time import sleep
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from recipes.images import process_pending_jobs
+
+
+class Command(BaseCommand):
+    """
+    Обработчик загруженных изображений: выполняет задания ImageJob
+    (см. recipes/images.py). Запускается отдельным процессом рядом с
+    gunicorn.
+    """
+
+    help = 'Обрабатывает загруженные изображения рецептов и аватары'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Обработать накопившиеся задания и завершиться'
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=2,
+            help='Пауза между проверками очереди, сек.'
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            processed = process_pending_jobs()
+            if processed:
+                self.stdout.write(f'Обработано изображений: {processed}')
+            if options['once']:
+                return
+            sleep(options['interval'])
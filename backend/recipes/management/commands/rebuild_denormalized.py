@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from recipes.counters import rebuild_counters
+from recipes.shopping_lists import rebuild_shopping_lists
+from recipes.tag_masks import rebuild_tag_masks
+
+
+class Command(BaseCommand):
+    """
+    Пересчитывает денормализованные данные и исправляет расхождения
+    с исходными таблицами.
+    """
+
+    help = (
+        'Пересчитывает денормализованные счетчики, маски тегов '
+        'и списки покупок'
+    )
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        fixed = rebuild_counters()
+        fixed['recipes.Recipe.tags_mask'] = rebuild_tag_masks()
+        fixed['recipes.ShoppingListItem'] = rebuild_shopping_lists()
+        for field, count in fixed.items():
+            self.stdout.write(
+                self.style.SUCCESS(f'{field}: исправлено записей {count}')
+            )
@@ -0,0 +1,27 @@
+# Generated by Django 3.2.3 on 2026-10-17 06:54
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TableVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True, verbose_name='Таблица')),
+                ('version', models.PositiveBigIntegerField(default=0, verbose_name='Версия')),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Изменена')),
+            ],
+            options={
+                'verbose_name': 'Версия таблицы',
+                'verbose_name_plural': 'Версии таблиц',
+            },
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 3.2.3 on 2026-10-17 06:59
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+# (модель со счетчиком, поле счетчика, модель считаемых записей, связь)
+COUNTERS = (
+    ('recipes.User', 'recipes_count', 'recipes.Recipe', 'author'),
+    ('recipes.User', 'subscribers_count', 'recipes.Follow', 'author'),
+    ('recipes.User', 'subscriptions_count', 'recipes.Follow', 'from_user'),
+    ('recipes.Recipe', 'favorites_count', 'recipes.Favorite', 'recipe'),
+)
+
+
+def fill_counters(apps, schema_editor):
+    for counter_label, field, label, relation in COUNTERS:
+        apps.get_model(counter_label).objects.update(**{
+            field: Coalesce(Subquery(
+                apps.get_model(label).objects.filter(
+                    **{relation: OuterRef('pk')}
+                ).order_by().values(relation).annotate(
+                    count=Count('pk')
+                ).values('count')
+            ), 0)
+        })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0003_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='favorites_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='В избранном'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='recipes_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Рецептов'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='subscribers_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Подписчиков'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='subscriptions_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Подписан на'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 3.2.3 on 2026-10-17 09:12
+
+from django.db import migrations, models
+
+# Число битов маски тегов (BigIntegerField без знакового бита)
+MAX_TAGS = 63
+
+
+def fill_tags_masks(apps, schema_editor):
+    Tag = apps.get_model('recipes', 'Tag')
+    Recipe = apps.get_model('recipes', 'Recipe')
+    tags = list(Tag.objects.order_by('pk'))
+    if len(tags) > MAX_TAGS:
+        raise ValueError(f'Тегов больше {MAX_TAGS}: маска их не вместит')
+    for bit, tag in enumerate(tags):
+        tag.bit = bit
+    Tag.objects.bulk_update(tags, ('bit',), batch_size=1000)
+    masks = {}
+    for recipe_id, bit in Recipe.tags.through.objects.values_list(
+        'recipe_id', 'tag__bit'
+    ):
+        masks[recipe_id] = masks.get(recipe_id, 0) | 1 << bit
+    Recipe.objects.bulk_update(
+        [
+            Recipe(pk=recipe_id, tags_mask=mask)
+            for recipe_id, mask in masks.items()
+        ],
+        ('tags_mask',),
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0004_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tag',
+            name='bit',
+            field=models.PositiveSmallIntegerField(editable=False, null=True, verbose_name='Бит в маске тегов'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='tags_mask',
+            field=models.BigIntegerField(default=0, editable=False, verbose_name='Маска тегов'),
+        ),
+        migrations.RunPython(fill_tags_masks, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='tag',
+            name='bit',
+            field=models.PositiveSmallIntegerField(editable=False, unique=True, verbose_name='Бит в маске тегов'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.3 on 2026-10-17 07:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0008_image_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='image_variants',
+            field=models.BooleanField(default=False, editable=False, verbose_name='Варианты изображения созданы'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='avatar_variants',
+            field=models.BooleanField(default=False, editable=False, verbose_name='Варианты аватара созданы'),
+        ),
+    ]
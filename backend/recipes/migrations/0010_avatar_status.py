@@ -0,0 +1,18 @@
+# Generated by Django 3.2.3 on 2026-10-17 07:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0009_image_variants'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='avatar_status',
+            field=models.CharField(choices=[('pending', 'Обрабатывается'), ('ready', 'Готово'), ('failed', 'Ошибка обработки')], default='ready', editable=False, max_length=16, verbose_name='Обработка аватара'),
+        ),
+    ]
@@ -1,8 +1,15 @@
+from threading import local
+
 from django.contrib.auth.models import AbstractUser
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator, RegexValidator
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 
 from .constants import MIN_AMOUNT, MIN_COOKING_TIME
+from .images import ImageStatus, upload_storage
 
 MAX_LENGTH_NAME = 256
 OUTPUT_LIMITATION_NAME = 50
@@ -12,6 +19,14 @@ MAX_LENGTH_INGRED = 128
 MAX_LENGTH_MEASUREMENT = 64
 MAX_LENGTH_EMAIL = 254
 LENGTH_USERNAME = 150
+MAX_LENGTH_TABLE_NAME = 64
+MAX_LENGTH_FIELD_NAME = 64
+MAX_LENGTH_STATUS = 16
+# Таблицы, версии которых увеличатся при фиксации текущей транзакции
+pending_versions = local()
+# Число битов маски тегов рецепта (знаковое 64-битное поле)
+MAX_TAGS = 63
+TOO_MANY_TAGS = f'Нельзя создать больше {MAX_TAGS} тегов'
 USERNAME_REGEX_TEXT = 'Имя может содержать только буквы, цифры и знаки .@+-_'
 USERNAME_REGEX = r'^[\w.@+-]+$'
 
@@ -47,6 +62,28 @@ class User(AbstractUser):
         blank=True,
         null=True
     )
+    avatar_status = models.CharField(
+        'Обработка аватара',
+        max_length=MAX_LENGTH_STATUS,
+        choices=ImageStatus.choices,
+        default=ImageStatus.READY,
+        editable=False
+    )
+    avatar_variants = models.BooleanField(
+        'Варианты аватара созданы', default=False, editable=False
+    )
+    updated_at = models.DateTimeField('Дата изменения', auto_now=True)
+    # Денормализованные счетчики, поддерживаются сигналами
+    # и пересчитываются командой rebuild_denormalized
+    recipes_count = models.PositiveIntegerField(
+        'Рецептов', default=0, editable=False
+    )
+    subscribers_count = models.PositiveIntegerField(
+        'Подписчиков', default=0, editable=False
+    )
+    subscriptions_count = models.PositiveIntegerField(
+        'Подписан на', default=0, editable=False
+    )
 
     # Устанавливаем авторизацию по полю email
     USERNAME_FIELD = 'email'
@@ -111,6 +148,11 @@ class Tag(models.Model):
         max_length=MAX_LENGTH_TAG_SLUG,
         unique=True
     )
+    bit = models.PositiveSmallIntegerField(
+        verbose_name='Бит в маске тегов',
+        unique=True,
+        editable=False
+    )
 
     class Meta:
         verbose_name = 'Тэг'
@@ -120,6 +162,39 @@ class Tag(models.Model):
     def __str__(self):
         return self.name
 
+    def clean(self):
+        if self.bit is None:
+            self.assign_bits([self])
+
+    def save(self, *args, **kwargs):
+        if self.bit is None:
+            self.assign_bits([self])
+        super().save(*args, **kwargs)
+
+    @property
+    def mask(self):
+        return 1 << self.bit
+
+    @classmethod
+    def assign_bits(cls, tags):
+        """Назначает тегам без бита наименьшие свободные биты маски."""
+        used = set(cls.objects.values_list('bit', flat=True))
+        free = (bit for bit in range(MAX_TAGS) if bit not in used)
+        for tag in tags:
+            if tag.bit is None:
+                tag.bit = next(free, None)
+                if tag.bit is None:
+                    raise ValidationError(TOO_MANY_TAGS)
+        return tags
+
+    @staticmethod
+    def get_mask(tags):
+        """Маска набора тегов."""
+        mask = 0
+        for tag in tags:
+            mask |= tag.mask
+        return mask
+
 
 class Ingredient(models.Model):
     """Продукты для рецептов."""
@@ -180,17 +255,52 @@ class Recipe(models.Model):
         'Изображение рецепта',
         upload_to='recipes/',
     )
+    image_status = models.CharField(
+        'Обработка изображения',
+        max_length=MAX_LENGTH_STATUS,
+        choices=ImageStatus.choices,
+        default=ImageStatus.READY,
+        editable=False
+    )
+    image_variants = models.BooleanField(
+        'Варианты изображения созданы', default=False, editable=False
+    )
     pub_date = models.DateTimeField('Дата публикации', auto_now_add=True)
+    updated_at = models.DateTimeField('Дата изменения', auto_now=True)
+    favorites_count = models.PositiveIntegerField(
+        'В избранном', default=0, editable=False
+    )
+    # Биты тегов рецепта (Tag.bit): фильтр по тегам без соединения таблиц.
+    # Поддерживается сигналами m2m_changed и командой rebuild_denormalized.
+    tags_mask = models.BigIntegerField(
+        'Маска тегов', default=0, editable=False
+    )
 
     class Meta:
         default_related_name = '%(model_name)ss'
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
         ordering = ('-pub_date',)
+        indexes = [
+            # Лента рецептов и курсоры пагинации: (-pub_date, -id)
+            models.Index(
+                fields=['-pub_date', '-id'], name='recipe_pub_date_idx'
+            ),
+            # Рецепты автора (страница автора, подписки) в порядке ленты
+            models.Index(
+                fields=['author', '-pub_date', '-id'],
+                name='recipe_author_pub_date_idx'
+            ),
+        ]
 
     def __str__(self):
         return self.name[:OUTPUT_LIMITATION_NAME]
 
+    @classmethod
+    def touch(cls, *recipe_ids):
+        """Отмечает рецепты измененными без их сохранения."""
+        cls.objects.filter(pk__in=recipe_ids).update(updated_at=timezone.now())
+
 
 class RecipeIngredient(models.Model):
     """Связующая модель рецептов и продуктов с мерой."""
@@ -219,6 +329,14 @@ class RecipeIngredient(models.Model):
         default_related_name = '%(model_name)ss'
         verbose_name = 'Продукт в рецепте с мерой'
         verbose_name_plural = 'Продукты в рецептах с мерой'
+        indexes = [
+            # Сводный список покупок: продукты и меры рецептов корзины
+            # читаются из индекса, без обращения к таблице
+            models.Index(
+                fields=['recipe', 'ingredient', 'amount'],
+                name='recipeingredient_cart_idx'
+            ),
+        ]
 
 
 class AbstractUserRecipeRelation(models.Model):
@@ -263,3 +381,194 @@ class ShoppingCart(AbstractUserRecipeRelation):
     class Meta(AbstractUserRecipeRelation.Meta):
         verbose_name = 'Список покупок'
         verbose_name_plural = 'Список покупок'
+
+
+class ShoppingListItem(models.Model):
+    """
+    Сводный список покупок пользователя: суммарная мера каждого продукта
+    по рецептам в его корзине. Поддерживается при изменении корзины и
+    продуктов рецептов (см. recipes/shopping_lists.py).
+    """
+
+    user = models.ForeignKey(
+        User,
+        verbose_name='Пользователь',
+        on_delete=models.CASCADE
+    )
+    ingredient = models.ForeignKey(
+        Ingredient,
+        verbose_name='Продукт',
+        on_delete=models.CASCADE
+    )
+    amount = models.PositiveIntegerField(verbose_name='Количество')
+
+    class Meta:
+        default_related_name = '%(model_name)ss'
+        verbose_name = 'Продукт в списке покупок'
+        verbose_name_plural = 'Сводные списки покупок'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'ingredient'],
+                name='shoppinglistitem_unique'
+            )
+        ]
+
+    def __str__(self):
+        return f'{self.user}: {self.ingredient} {self.amount}'
+
+
+class ImageJob(models.Model):
+    """
+    Задание на обработку загруженного изображения поля field_name
+    объекта target (см. recipes/images.py).
+    """
+
+    class Status(models.TextChoices):
+        PENDING = 'pending', 'Ожидает'
+        PROCESSING = 'processing', 'Обрабатывается'
+        FAILED = 'failed', 'Ошибка'
+
+    content_type = models.ForeignKey(
+        ContentType,
+        verbose_name='Тип объекта',
+        on_delete=models.CASCADE
+    )
+    object_id = models.PositiveBigIntegerField(verbose_name='Id объекта')
+    target = GenericForeignKey()
+    field_name = models.CharField(
+        verbose_name='Поле',
+        max_length=MAX_LENGTH_FIELD_NAME
+    )
+    source = models.FileField(
+        verbose_name='Загруженный файл',
+        upload_to='images/',
+        storage=upload_storage
+    )
+    status = models.CharField(
+        verbose_name='Состояние',
+        max_length=MAX_LENGTH_STATUS,
+        choices=Status.choices,
+        default=Status.PENDING
+    )
+    attempts = models.PositiveSmallIntegerField(
+        verbose_name='Попыток', default=0
+    )
+    error = models.TextField(verbose_name='Ошибка', blank=True)
+    created_at = models.DateTimeField('Создано', auto_now_add=True)
+    updated_at = models.DateTimeField('Изменено', auto_now=True)
+
+    class Meta:
+        verbose_name = 'Обработка изображения'
+        verbose_name_plural = 'Обработка изображений'
+        ordering = ('created_at',)
+        indexes = [
+            models.Index(
+                fields=['status', 'created_at'], name='imagejob_queue_idx'
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.content_type}:{self.object_id}.{self.field_name}'
+
+    @staticmethod
+    def target_filter(instance, field_name):
+        """Условие выборки заданий поля объекта."""
+        return models.Q(
+            content_type=ContentType.objects.get_for_model(instance),
+            object_id=instance.pk,
+            field_name=field_name
+        )
+
+    def is_superseded(self):
+        """В то же поле загрузили новое изображение после этого."""
+        return ImageJob.objects.filter(
+            models.Q(
+                content_type_id=self.content_type_id,
+                object_id=self.object_id,
+                field_name=self.field_name
+            ),
+            pk__gt=self.pk
+        ).exists()
+
+
+class TableVersion(models.Model):
+    """
+    Версии таблиц. Увеличиваются при каждом изменении данных таблицы
+    и служат ключом для кэшей, производных от этих данных.
+    """
+
+    name = models.CharField(
+        verbose_name='Таблица',
+        max_length=MAX_LENGTH_TABLE_NAME,
+        unique=True
+    )
+    version = models.PositiveBigIntegerField(
+        verbose_name='Версия',
+        default=0
+    )
+    updated_at = models.DateTimeField(
+        verbose_name='Изменена',
+        default=timezone.now
+    )
+
+    class Meta:
+        verbose_name = 'Версия таблицы'
+        verbose_name_plural = 'Версии таблиц'
+
+    def __str__(self):
+        return f'{self.name}: {self.version}'
+
+    @classmethod
+    def bump(cls, *names):
+        """Увеличивает версии перечисленных таблиц."""
+        for name in names:
+            updated = cls.objects.filter(name=name).update(
+                version=models.F('version') + 1,
+                updated_at=timezone.now()
+            )
+            if not updated:
+                cls.objects.get_or_create(name=name, defaults={'version': 1})
+
+    @classmethod
+    def bump_on_commit(cls, *names):
+        """
+        Увеличивает версии таблиц после фиксации транзакции, по разу на
+        таблицу: записи транзакции не ждут блокировку строк версий и не
+        сбрасывают кэши многократно. Вне транзакции версии меняются сразу.
+        """
+        if not hasattr(pending_versions, 'names'):
+            pending_versions.names = set()
+        # После отката имена останутся до следующей фиксации: лишнее
+        # увеличение версии только сбросит кэши
+        pending_versions.names.update(names)
+        transaction.on_commit(cls.flush_pending)
+
+    @classmethod
+    def flush_pending(cls):
+        """Увеличивает отложенные версии (первый вызов после фиксации)."""
+        names = sorted(getattr(pending_versions, 'names', ()))
+        if names:
+            pending_versions.names.clear()
+            # Одинаковый порядок таблиц исключает взаимные блокировки
+            cls.bump(*names)
+
+    @classmethod
+    def get_state(cls, *names):
+        """
+        Возвращает одним запросом версии таблиц и время последнего
+        изменения любой из них (None, если таблицы не менялись).
+        """
+        versions = dict.fromkeys(names, 0)
+        last_modified = None
+        for name, version, updated_at in cls.objects.filter(
+            name__in=names
+        ).values_list('name', 'version', 'updated_at'):
+            versions[name] = version
+            if last_modified is None or updated_at > last_modified:
+                last_modified = updated_at
+        return versions, last_modified
+
+    @classmethod
+    def get_versions(cls, *names):
+        """Возвращает версии таблиц одним запросом."""
+        return cls.get_state(*names)[0]
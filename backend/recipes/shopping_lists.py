@@ -0,0 +1,141 @@
+"""
+Сводные списки покупок (ShoppingListItem).
+
+Меры продуктов меняются на разницу: при добавлении рецепта в корзину и
+удалении из нее (сигналы), а также при изменении продуктов рецепта,
+который лежит в чьих-то корзинах (change_recipe,
+track_recipe_ingredients). Списки
+пересчитываются целиком командой rebuild_denormalized.
+"""
+from contextlib import contextmanager
+
+from django.apps import apps as global_apps
+from django.db.models import Case, F, Sum, Value, When
+from django.db.models.functions import Greatest
+
+
+def get_recipe_amounts(*recipe_ids):
+    """Меры продуктов рецептов: {(id рецепта, id продукта): мера}."""
+    RecipeIngredient = global_apps.get_model('recipes.RecipeIngredient')
+    return {
+        (row['recipe_id'], row['ingredient_id']): row['total']
+        for row in RecipeIngredient.objects.filter(
+            recipe_id__in=recipe_ids
+        ).values('recipe_id', 'ingredient_id').annotate(total=Sum('amount'))
+    }
+
+
+def change_shopping_lists(user_ids, deltas):
+    """
+    Изменяет меры продуктов в списках пользователей на deltas
+    ({id продукта: разница}). Продукты с нулевой мерой удаляются.
+    """
+    ShoppingListItem = global_apps.get_model('recipes.ShoppingListItem')
+    deltas = {
+        ingredient_id: delta for ingredient_id, delta in deltas.items()
+        if delta
+    }
+    if not user_ids or not deltas:
+        return
+    ShoppingListItem.objects.bulk_create(
+        (
+            ShoppingListItem(
+                user_id=user_id, ingredient_id=ingredient_id, amount=0
+            )
+            for user_id in user_ids
+            for ingredient_id, delta in deltas.items() if delta > 0
+        ),
+        ignore_conflicts=True
+    )
+    items = ShoppingListItem.objects.filter(
+        user_id__in=user_ids, ingredient_id__in=deltas
+    )
+    items.update(amount=Greatest(F('amount') + Case(
+        *(
+            When(ingredient_id=ingredient_id, then=Value(delta))
+            for ingredient_id, delta in deltas.items()
+        ),
+        default=Value(0)
+    ), 0))
+    items.filter(amount=0).delete()
+
+
+def change_cart(cart, sign):
+    """Добавляет (sign=1) или вычитает (sign=-1) рецепт из списка покупок."""
+    change_shopping_lists([cart.user_id], {
+        ingredient_id: sign * amount
+        for (_, ingredient_id), amount in get_recipe_amounts(
+            cart.recipe_id
+        ).items()
+    })
+
+
+def change_recipe(recipe_id, deltas):
+    """
+    Переносит изменение мер продуктов рецепта ({id продукта: разница})
+    в списки покупок пользователей, у которых рецепт в корзине.
+    """
+    if not any(deltas.values()):
+        return
+    change_shopping_lists(
+        list(global_apps.get_model('recipes.ShoppingCart').objects.filter(
+            recipe_id=recipe_id
+        ).values_list('user_id', flat=True)),
+        deltas
+    )
+
+
+@contextmanager
+def track_recipe_ingredients(*recipe_ids):
+    """
+    Переносит в списки покупок изменения продуктов рецептов, сделанные
+    внутри блока with.
+    """
+    before = get_recipe_amounts(*recipe_ids)
+    yield
+    after = get_recipe_amounts(*recipe_ids)
+    deltas = {}
+    for key in before.keys() | after.keys():
+        recipe_id, ingredient_id = key
+        deltas.setdefault(recipe_id, {})[ingredient_id] = (
+            after.get(key, 0) - before.get(key, 0)
+        )
+    for recipe_id, recipe_deltas in deltas.items():
+        change_recipe(recipe_id, recipe_deltas)
+
+
+def rebuild_shopping_lists():
+    """
+    Пересчитывает списки покупок по корзинам и исправляет расхождения.
+    Возвращает число исправленных записей.
+    """
+    ShoppingCart = global_apps.get_model('recipes.ShoppingCart')
+    ShoppingListItem = global_apps.get_model('recipes.ShoppingListItem')
+    actual = {
+        (row['user_id'], row['ingredient_id']): row['total']
+        for row in ShoppingCart.objects.values(
+            'user_id', ingredient_id=F('recipe__recipeingredients__ingredient')
+        ).annotate(total=Sum('recipe__recipeingredients__amount'))
+        # Рецепт без продуктов не добавляет в список ничего
+        if row['ingredient_id'] is not None
+    }
+    stored = {
+        (item.user_id, item.ingredient_id): item
+        for item in ShoppingListItem.objects.all()
+    }
+    extra = [item.pk for key, item in stored.items() if key not in actual]
+    changed = []
+    for key, item in stored.items():
+        if key in actual and item.amount != actual[key]:
+            item.amount = actual[key]
+            changed.append(item)
+    missing = [
+        ShoppingListItem(user_id=user_id, ingredient_id=ingredient_id,
+                         amount=amount)
+        for (user_id, ingredient_id), amount in actual.items()
+        if (user_id, ingredient_id) not in stored
+    ]
+    ShoppingListItem.objects.filter(pk__in=extra).delete()
+    ShoppingListItem.objects.bulk_update(changed, ('amount',), batch_size=1000)
+    ShoppingListItem.objects.bulk_create(missing, batch_size=1000)
+    return len(extra) + len(changed) + len(missing)
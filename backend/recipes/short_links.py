@@ -0,0 +1,81 @@
+"""
+Короткие ссылки на рецепты.
+
+Код ссылки - id рецепта в системе счисления по основанию 62. Наличие
+рецепта проверяется через LRU-кэш процесса, в котором запоминаются и
+отсутствующие id. Удаление и создание рецепта сбрасывают запись в этом
+процессе (сигналы), в остальных процессах записи устаревают через
+settings.SHORT_LINK_CACHE_TIMEOUT секунд.
+"""
+from collections import OrderedDict
+from string import ascii_letters, digits
+from threading import Lock
+from time import monotonic
+
+from django.apps import apps as global_apps
+from django.conf import settings
+
+ALPHABET = digits + ascii_letters
+BASE = len(ALPHABET)
+DIGITS = {char: value for value, char in enumerate(ALPHABET)}
+
+
+def encode(number):
+    """Код ссылки для неотрицательного числа."""
+    code = ''
+    while True:
+        number, digit = divmod(number, BASE)
+        code = ALPHABET[digit] + code
+        if not number:
+            return code
+
+
+def decode(code):
+    """Число по коду ссылки или None для неверного кода."""
+    if not code or code[0] == ALPHABET[0] and len(code) > 1:
+        # У каждого числа один код: ведущие нули не допускаются
+        return None
+    number = 0
+    for char in code:
+        if char not in DIGITS:
+            return None
+        number = number * BASE + DIGITS[char]
+    return number
+
+
+class RecipeExistence:
+    """LRU-кэш наличия рецептов {id: (есть ли рецепт, время проверки)}."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.entries = OrderedDict()
+
+    def __call__(self, recipe_id):
+        now = monotonic()
+        with self.lock:
+            entry = self.entries.get(recipe_id)
+            if entry is not None and (
+                now - entry[1] < settings.SHORT_LINK_CACHE_TIMEOUT
+            ):
+                self.entries.move_to_end(recipe_id)
+                return entry[0]
+        exists = global_apps.get_model('recipes.Recipe').objects.filter(
+            pk=recipe_id
+        ).exists()
+        with self.lock:
+            self.entries[recipe_id] = (exists, now)
+            self.entries.move_to_end(recipe_id)
+            while len(self.entries) > settings.SHORT_LINK_CACHE_SIZE:
+                self.entries.popitem(last=False)
+        return exists
+
+    def forget(self, recipe_id):
+        with self.lock:
+            self.entries.pop(recipe_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+recipe_exists = RecipeExistence()
@@ -0,0 +1,134 @@
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import (
+    m2m_changed, post_delete, post_save, pre_delete
+)
+from django.dispatch import receiver
+
+from .counters import change_counters
+from .models import (
+    Favorite, Follow, Ingredient, Recipe, RecipeIngredient, ShoppingCart,
+    TableVersion, Tag, User
+)
+from .shopping_lists import change_cart
+from .short_links import recipe_exists
+
+# Таблицы, изменения которых отражаются в версиях (см. TableVersion)
+VERSIONED_MODELS = (
+    Recipe, Favorite, ShoppingCart, Tag, Ingredient, User, Follow
+)
+
+
+# Поля, которых нет в ответах API: их сохранение версию не меняет
+# (last_login обновляется при каждом входе)
+UNVERSIONED_FIELDS = {User: frozenset({'last_login', 'password'})}
+
+
+def table_name(model):
+    return model._meta.model_name
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def bump_table_version(sender, update_fields=None, **kwargs):
+    """Увеличивает версию таблицы при изменении её записей."""
+    if sender not in VERSIONED_MODELS:
+        return
+    if update_fields and update_fields <= UNVERSIONED_FIELDS.get(
+        sender, frozenset()
+    ):
+        return
+    TableVersion.bump_on_commit(table_name(sender))
+
+
+@receiver(post_save)
+def increment_counters(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        change_counters(instance, 1)
+
+
+@receiver(post_delete)
+def decrement_counters(sender, instance, **kwargs):
+    change_counters(instance, -1)
+
+
+@receiver(post_save, sender=RecipeIngredient)
+@receiver(post_delete, sender=RecipeIngredient)
+def touch_recipe_on_ingredients(sender, instance, **kwargs):
+    """Изменение продуктов рецепта меняет версию самого рецепта."""
+    Recipe.touch(instance.recipe_id)
+    TableVersion.bump_on_commit(table_name(Recipe))
+
+
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def touch_recipes_on_tags(sender, instance, action, reverse, pk_set,
+                          **kwargs):
+    """
+    Смена тегов меняет версии затронутых рецептов и результаты
+    фильтрации рецептов.
+    """
+    if not reverse:
+        recipe_ids = [instance.pk]
+    elif action == 'pre_clear':
+        # После очистки связей рецепты тега уже не найти
+        recipe_ids = list(instance.recipes.values_list('pk', flat=True))
+    else:
+        recipe_ids = pk_set or []
+    if action in ('post_add', 'post_remove', 'pre_clear'):
+        Recipe.touch(*recipe_ids)
+    if action.startswith('post_'):
+        TableVersion.bump_on_commit(table_name(Recipe))
+
+
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def sync_tags_mask(sender, instance, action, reverse, pk_set, **kwargs):
+    """Поддерживает маски тегов рецептов (Recipe.tags_mask)."""
+    if not reverse:
+        if action.startswith('post_'):
+            Recipe.objects.filter(pk=instance.pk).update(
+                tags_mask=Tag.get_mask(instance.tags.all())
+            )
+    elif action == 'post_add':
+        Recipe.objects.filter(pk__in=pk_set).update(
+            tags_mask=F('tags_mask').bitor(instance.mask)
+        )
+    elif action == 'post_remove':
+        Recipe.objects.filter(pk__in=pk_set).update(
+            tags_mask=F('tags_mask').bitand(~instance.mask)
+        )
+    elif action == 'pre_clear':
+        clear_tag_bit(Tag, instance)
+
+
+@receiver(pre_delete, sender=Tag)
+def clear_tag_bit(sender, instance, **kwargs):
+    """Связи удаляемого тега удаляются без m2m_changed: снимаем бит сами."""
+    instance.recipes.update(tags_mask=F('tags_mask').bitand(~instance.mask))
+
+
+@receiver(post_save, sender=ShoppingCart)
+def add_to_shopping_list(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        change_cart(instance, 1)
+
+
+@receiver(pre_delete, sender=ShoppingCart)
+def remove_from_shopping_list(sender, instance, **kwargs):
+    """
+    Вычитаем до удаления: при удалении рецепта его продукты удаляются
+    вместе с корзинами, и после удаления их меры уже не получить.
+    """
+    change_cart(instance, -1)
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_delete, sender=Recipe)
+def forget_recipe_existence(sender, instance, **kwargs):
+    """
+    Сбрасывает запомненное наличие рецепта для коротких ссылок сразу и
+    после фиксации транзакции: до нее другой запрос мог запомнить
+    прежнее состояние.
+    """
+    recipe_id = instance.pk
+    recipe_exists.forget(recipe_id)
+    transaction.on_commit(lambda: recipe_exists.forget(recipe_id))
@@ -0,0 +1,29 @@
+"""
+Маски тегов рецептов.
+
+Каждому тегу назначен свой бит (Tag.bit), маска рецепта (Recipe.tags_mask)
+- побитовое ИЛИ битов его тегов. Фильтр по тегам сводится к одному
+условию над полем рецепта вместо соединения с таблицей связей и DISTINCT.
+Маски меняются сигналами m2m_changed и пересчитываются командой
+rebuild_denormalized.
+"""
+from .models import Recipe
+
+
+def rebuild_tag_masks():
+    """
+    Пересчитывает маски тегов рецептов по таблице связей.
+    Возвращает число исправленных рецептов.
+    """
+    actual = {}
+    for recipe_id, bit in Recipe.tags.through.objects.values_list(
+        'recipe_id', 'tag__bit'
+    ):
+        actual[recipe_id] = actual.get(recipe_id, 0) | 1 << bit
+    changed = [
+        Recipe(pk=recipe_id, tags_mask=actual.get(recipe_id, 0))
+        for recipe_id, mask in Recipe.objects.values_list('pk', 'tags_mask')
+        if actual.get(recipe_id, 0) != mask
+    ]
+    Recipe.objects.bulk_update(changed, ('tags_mask',), batch_size=1000)
+    return len(changed)
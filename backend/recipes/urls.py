@@ -1,11 +1,17 @@
 from django.conf import settings
 from django.urls import path
 
-from .views import get_short_link_recipe
+from .views import get_short_code_recipe, get_short_link_recipe
 
 app_name = 'recipes'
 
 urlpatterns = [
+    path(
+        f'{settings.SHORT_CODE_PREFIX}<str:code>/',
+        get_short_code_recipe,
+        name='recipe_short_code'
+    ),
+    # Ссылки по id, выданные до появления кодов
     path(
         f'{settings.SHORT_URL_PREFIX}<int:recipe_id>/',
         get_short_link_recipe,
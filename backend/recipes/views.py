@@ -1,12 +1,27 @@
-from django.core.exceptions import ValidationError
+from django.conf import settings
+from django.http import Http404
 from django.shortcuts import redirect
+from django.utils.cache import patch_cache_control
 
 from .constants import RECIPE_NOT_FOUND
-from .models import Recipe
+from .short_links import decode, recipe_exists
 
 
 def get_short_link_recipe(request, recipe_id):
     """Выводит страницу по короткой ссылке."""
-    if not Recipe.objects.filter(pk=recipe_id).exists():
-        raise ValidationError(RECIPE_NOT_FOUND.format(recipe_id))
-    return redirect(f'/recipes/{recipe_id}/')
+    if not recipe_exists(recipe_id):
+        raise Http404(RECIPE_NOT_FOUND.format(recipe_id))
+    response = redirect(f'/recipes/{recipe_id}/')
+    # Повторные переходы по ссылке отдает кэш nginx
+    patch_cache_control(
+        response, public=True, max_age=settings.SHORT_LINK_CACHE_TIMEOUT
+    )
+    return response
+
+
+def get_short_code_recipe(request, code):
+    """Выводит страницу по коду короткой ссылки (см. short_links.py)."""
+    recipe_id = decode(code)
+    if recipe_id is None:
+        raise Http404(RECIPE_NOT_FOUND.format(code))
+    return get_short_link_recipe(request, recipe_id)